@@ -0,0 +1,88 @@
+import hashlib
+from collections import Counter
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from recipes.versions import bump_version, get_version
+
+GENERATION_KEY = 'recipes_generation'
+FRAGMENT_GENERATION_KEY = 'recipe_fragments_generation'
+
+# Счетчики попаданий и промахов кэша в текущем процессе, их отдает
+# /api/recipes/cache_stats/.
+metrics = Counter()
+
+
+def current_generation(key=GENERATION_KEY):
+    return get_version(key)
+
+
+def bump_generation(key=GENERATION_KEY):
+    """Делает недействительными закэшированные ответы о рецептах.
+
+    Поколение хранится в базе, чтобы сброс доходил до всех процессов,
+    и меняется после фиксации транзакции: иначе запрос, пришедший до
+    коммита, сохранил бы старые данные под новым ключом. Повторные
+    вызовы в одной транзакции меняют поколение один раз.
+    """
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(
+        isinstance(func, partial) and func.func is bump_version
+        and func.args == (key,)
+        for _, func, *_ in connection.run_on_commit
+    ):
+        return
+    transaction.on_commit(partial(bump_version, key))
+
+
+def fragment_keys(recipes):
+    """Ключи закэшированных представлений рецептов по id и версии.
+
+    Версия - updated_at рецепта, поэтому представление, собранное по
+    старым строкам, никогда не находится по ключу измененного рецепта.
+    Изменения тегов, ингредиентов и авторов меняют поколение.
+    """
+    generation = current_generation(FRAGMENT_GENERATION_KEY)
+    return {
+        recipe.id: (f'recipe_fragment:{generation}:{recipe.id}:'
+                    f'{recipe.updated_at.timestamp()}')
+        for recipe in recipes
+    }
+
+
+def response_cache_key(request, action, kwargs):
+    params = sorted(
+        (key, sorted(values))
+        for key, values in request.query_params.lists()
+    )
+    digest = hashlib.md5(
+        repr((request.get_host(), sorted(kwargs.items()), params)).encode()
+    ).hexdigest()
+    return f'recipes:{current_generation()}:{action}:{digest}'
+
+
+def cache_anonymous_response(method):
+    """Кэширует ответы анонимным пользователям до изменения данных."""
+    @wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return method(view, request, *args, **kwargs)
+        key = response_cache_key(request, view.action, kwargs)
+        data = cache.get(key)
+        if data is not None:
+            metrics['hit'] += 1
+            response = Response(data)
+            response['X-Cache'] = 'HIT'
+            return response
+        metrics['miss'] += 1
+        response = method(view, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, settings.RECIPE_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
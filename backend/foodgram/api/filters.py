@@ -1,9 +1,97 @@
 from django.contrib.auth import get_user_model
+from django.db.models import Exists, Max, OuterRef, Q
+from django_filters import rest_framework as filters
 from rest_framework.filters import SearchFilter
 
+from recipes.models import Cart, Favorite, PopularityWindow, Recipe
+
 User = get_user_model()
 
 
 class IngredientSearchFilter(SearchFilter):
     """Фильтрация поиска ингредиентов"""
     search_param = 'name'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        return queryset.search(query)
+
+
+class AuthorAndTagFilter(filters.FilterSet):
+    """Фильтрация, поиск и сортировка рецептов.
+
+    Связи проверяются подзапросами EXISTS: строки рецептов не
+    размножаются соединениями, DISTINCT не нужен, фильтры сочетаются.
+    """
+    ids = filters.CharFilter(method='filter_ids')
+    author = filters.NumberFilter(field_name='author_id')
+    tags = filters.CharFilter(method='filter_tags')
+    is_favorited = filters.BooleanFilter(method='filter_user_relation')
+    is_in_shopping_cart = filters.BooleanFilter(
+        method='filter_user_relation'
+    )
+    search = filters.CharFilter(method='filter_search')
+    ordering = filters.ChoiceFilter(
+        choices=(('popular', 'По популярности'),),
+        method='filter_ordering',
+    )
+    period = filters.ChoiceFilter(
+        choices=PopularityWindow.choices,
+        method='filter_period',
+    )
+
+    relations = {
+        'is_favorited': Favorite,
+        'is_in_shopping_cart': Cart,
+    }
+
+    class Meta:
+        model = Recipe
+        fields = ('ids', 'author', 'tags', 'is_favorited',
+                  'is_in_shopping_cart', 'search', 'ordering', 'period')
+
+    def filter_ids(self, queryset, name, value):
+        return queryset.filter(id__in=[
+            pk for pk in value.split(',') if pk.strip().isdigit()
+        ])
+
+    def filter_tags(self, queryset, name, value):
+        slugs = self.request.query_params.getlist(name)
+        return queryset.filter(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('pk'), tag__slug__in=slugs
+        )))
+
+    def filter_search(self, queryset, name, value):
+        value = value.strip()
+        return queryset.search(value) if value else queryset
+
+    def filter_ordering(self, queryset, name, value):
+        """Порядок из рейтингов, которые считает materialize_popular.
+
+        Период - параметр period (по умолчанию неделя), при заданных
+        тегах используются рейтинги этих тегов.
+        """
+        window = self.form.cleaned_data.get('period') or PopularityWindow.WEEK
+        tags = self.request.query_params.getlist('tags')
+        ranking = (
+            Q(popularity__tag__slug__in=tags) if tags
+            else Q(popularity__tag__isnull=True)
+        )
+        return queryset.filter(ranking, popularity__window=window).annotate(
+            popular_score=Max('popularity__score')
+        ).order_by('-popular_score', '-id')
+
+    def filter_period(self, queryset, name, value):
+        # Учитывается в filter_ordering.
+        return queryset
+
+    def filter_user_relation(self, queryset, name, value):
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.none() if value else queryset
+        related = Exists(self.relations[name].objects.filter(
+            user_id=user.id, recipe_id=OuterRef('pk')
+        ))
+        return queryset.filter(related if value else ~related)
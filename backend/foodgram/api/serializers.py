@@ -1,13 +1,20 @@
 # isort: skip_file
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
-from django.shortcuts import get_object_or_404
+from django.db.models.deletion import Collector
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers, status
+from rest_framework.exceptions import NotFound
 
 import users.api.serializers as us
+from api.cache import fragment_keys
+from api.viewer_state import viewer_state
 from foodgram.utils import (
     LOW_COOKING_LIMIT,
     LOW_INGREDIENT_LIMIT,
+    MAX_BATCH_SIZE,
+    get_recipes_limit,
     is_greater_than_zero
 )
 from recipes.models import (
@@ -16,16 +23,18 @@ from recipes.models import (
     Ingredient,
     Recipe,
     RecipeIngredient,
-    Tag
+    ShoppingListItem,
+    Tag,
+    prefetch_for_read
 )
-from users.models import Follow, User
+from users.models import User
 
 
 class TagSerializer(serializers.ModelSerializer):
     """Сериализатор тегов"""
     class Meta:
         model = Tag
-        fields = '__all__'
+        fields = ('id', 'name', 'color', 'slug')
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -54,6 +63,37 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 #       ]
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    """Собирает список из закэшированных представлений рецептов.
+
+    Используется, когда в контексте есть fragments: рецепты получены
+    без связей, но с флагами текущего пользователя (with_user_flags).
+    Связи загружаются и сериализуются только для промахов кэша.
+    """
+
+    def to_representation(self, data):
+        if not self.context.get('fragments'):
+            return super().to_representation(data)
+        recipes = list(data)
+        keys = fragment_keys(recipes)
+        fragments = cache.get_many(list(keys.values()))
+        missing = [
+            recipe for recipe in recipes if keys[recipe.id] not in fragments
+        ]
+        if missing:
+            prefetch_for_read(missing)
+            built = {
+                keys[recipe.id]: self.child.to_fragment(recipe)
+                for recipe in missing
+            }
+            cache.set_many(built, settings.RECIPE_FRAGMENT_TIMEOUT)
+            fragments.update(built)
+        return [
+            self.child.from_fragment(fragments[keys[recipe.id]], recipe)
+            for recipe in recipes
+        ]
+
+
 class ReadRecipeSerializer(serializers.ModelSerializer):
     """Сериализатор чтения рецепта"""
     image = Base64ImageField()
@@ -74,21 +114,58 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart', 'name', 'image', 'text',
             'cooking_time'
         )
+        list_serializer_class = RecipeListSerializer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed'):
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
+
+    def to_fragment(self, instance):
+        """Представление рецепта, общее для всех пользователей."""
+        data = self.to_representation(instance)
+        data['is_favorited'] = None
+        data['is_in_shopping_cart'] = None
+        data['author']['is_subscribed'] = None
+        data['image'] = instance.image.url if instance.image else None
+        return data
+
+    def from_fragment(self, fragment, instance):
+        """Дополняет общее представление флагами текущего пользователя."""
+        data = fragment.copy()
+        state = viewer_state(self.context['request'])
+        data['is_favorited'] = self.get_is_favorited(instance)
+        data['is_in_shopping_cart'] = self.get_is_in_shopping_cart(instance)
+        data['author'] = fragment['author'].copy()
+        data['author']['is_subscribed'] = (
+            instance.author_is_subscribed
+            if hasattr(instance, 'author_is_subscribed')
+            else state.is_subscribed(instance.author_id)
+        )
+        if data['image']:
+            data['image'] = self.context['request'].build_absolute_uri(
+                data['image']
+            )
+        return data
 
     def get_is_favorited(self, obj):
-        return (
-            self.context.get('request').user.is_authenticated
-            and Favorite.objects.filter(user=self.context['request'].user,
-                                        recipe=obj).exists()
-        )
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
+        return viewer_state(self.context['request']).is_favorited(obj.id)
 
     def get_is_in_shopping_cart(self, obj):
-        return (
-            self.context.get('request').user.is_authenticated
-            and Cart.objects.filter(
-                user=self.context['request'].user,
-                recipe=obj).exists()
-        )
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
+        return viewer_state(
+            self.context['request']
+        ).is_in_shopping_cart(obj.id)
 
 
 class CreateRecipeSerializer(ReadRecipeSerializer):
@@ -109,26 +186,67 @@ class CreateRecipeSerializer(ReadRecipeSerializer):
             'is_in_shopping_cart', 'name', 'image', 'text',
             'cooking_time'
         )
+        list_serializer_class = RecipeListSerializer
 
     def validate(self, value):
         ingredients = self.initial_data.get('ingredients')
-        if not value:
+        tags = self.initial_data.get('tags')
+        if ingredients is not None or not self.partial:
+            value['ingredients'] = self.validate_ingredients_data(ingredients)
+        if tags is not None or not self.partial:
+            value['tags'] = self.validate_tags_data(tags)
+        return value
+
+    def validate_ingredients_data(self, ingredients):
+        """Проверяет все ингредиенты одним запросом к базе."""
+        if not ingredients:
             raise serializers.ValidationError({
                 'ingredients': 'Нужен хотя бы один ингридиент для рецепта'
             })
-        ingredient_list = []
-        for ingredient_item in ingredients:
-            ingredient = get_object_or_404(Ingredient,
-                                           id=ingredient_item['id'])
-            if ingredient in ingredient_list:
-                raise serializers.ValidationError(
-                    'Ингредиент должен быть уникальным!')
-            is_greater_than_zero(int(ingredient_item['amount']),
+        try:
+            amounts = {
+                int(item['id']): int(item['amount']) for item in ingredients
+            }
+        except (KeyError, TypeError, ValueError):
+            raise serializers.ValidationError({
+                'ingredients': 'Укажите id и количество каждого ингредиента'
+            })
+        if len(amounts) != len(ingredients):
+            raise serializers.ValidationError(
+                'Ингредиент должен быть уникальным!')
+        for amount in amounts.values():
+            is_greater_than_zero(amount,
                                  f'Убедитесь, что значение количества '
                                  f'ингредиента не менее '
                                  f'{LOW_INGREDIENT_LIMIT}')
-            ingredient_list.append(ingredient)
-        return value
+        found = set(Ingredient.objects.filter(
+            id__in=amounts
+        ).values_list('id', flat=True))
+        if len(found) != len(amounts):
+            raise NotFound()
+        return amounts
+
+    def validate_tags_data(self, tags):
+        """Проверяет все теги одним запросом к базе."""
+        if not tags:
+            raise serializers.ValidationError({
+                'tags': 'Нужен хотя бы один тег для рецепта'
+            })
+        try:
+            tag_ids = {int(tag) for tag in tags}
+        except (TypeError, ValueError):
+            raise serializers.ValidationError({
+                'tags': 'Некорректный идентификатор тега'
+            })
+        if len(tag_ids) != len(tags):
+            raise serializers.ValidationError({
+                'tags': 'Тег должен быть уникальным!'
+            })
+        if Tag.objects.filter(id__in=tag_ids).count() != len(tag_ids):
+            raise serializers.ValidationError({
+                'tags': 'Указан несуществующий тег'
+            })
+        return tag_ids
 
     def validate_cooking_time(self, value):
         if not value:
@@ -142,40 +260,101 @@ class CreateRecipeSerializer(ReadRecipeSerializer):
         return value
 
     def create_ingredients(self, ingredients, recipe):
-        for ingredient in ingredients:
-            RecipeIngredient.objects.create(
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
                 recipe=recipe,
-                ingredient_id=ingredient.get('id'),
-                amount=ingredient.get('amount'),
+                ingredient_id=ingredient_id,
+                amount=amount,
             )
+            for ingredient_id, amount in ingredients.items()
+        )
 
     @transaction.atomic
     def create(self, validated_data):
         image = validated_data.pop('image')
-        ingredients_data = self.initial_data.get('ingredients')
+        ingredients_data = validated_data.pop('ingredients')
+        tags_data = validated_data.pop('tags')
         recipe = Recipe.objects.create(image=image, **validated_data)
-        tags_data = self.initial_data.get('tags')
         recipe.tags.set(tags_data)
         self.create_ingredients(ingredients_data, recipe)
-        return recipe
+        return Recipe.objects.for_read(
+            self.context['request'].user
+        ).get(pk=recipe.pk)
+
+    def update_ingredients(self, ingredients, recipe):
+        """Применяет только изменившиеся ингредиенты рецепта."""
+        current = {
+            item.ingredient_id: item
+            for item in recipe.recipe_ingredient.all()
+        }
+        removed = [
+            item for ingredient_id, item in current.items()
+            if ingredient_id not in ingredients
+        ]
+        if removed:
+            # С рецептом в origin сигналы удаления не меняют списки
+            # покупок и индексы построчно: это делают deltas ниже и
+            # perform_update.
+            collector = Collector(using=recipe._state.db, origin=recipe)
+            collector.collect(removed)
+            collector.delete()
+        deltas = {item.ingredient_id: -item.amount for item in removed}
+        changed = []
+        for ingredient_id, amount in ingredients.items():
+            item = current.get(ingredient_id)
+            if item is not None and item.amount != amount:
+                deltas[ingredient_id] = amount - item.amount
+                item.amount = amount
+                changed.append(item)
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
+        created = {
+            ingredient_id: amount
+            for ingredient_id, amount in ingredients.items()
+            if ingredient_id not in current
+        }
+        self.create_ingredients(created, recipe)
+        deltas.update(created)
+        ShoppingListItem.objects.change_recipe(recipe.id, deltas)
+
+    @staticmethod
+    def image_changed(stored, uploaded):
+        if not stored:
+            return True
+        try:
+            if stored.size != uploaded.size:
+                return True
+            with stored.open('rb') as stored_file:
+                same = stored_file.read() == uploaded.read()
+        except OSError:
+            return True
+        uploaded.seek(0)
+        return not same
 
     @transaction.atomic
     def update(self, instance, validated_data):
-        instance.image = validated_data.get('image', instance.image)
-        instance.name = validated_data.get('name', instance.name)
-        instance.text = validated_data.get('text', instance.text)
-        instance.cooking_time = validated_data.get(
-            'cooking_time', instance.cooking_time
-        )
-        instance.tags.clear()
-        tags_data = self.initial_data.get('tags')
-        instance.tags.set(tags_data)
-        RecipeIngredient.objects.filter(recipe=instance).all().delete()
-        self.create_ingredients(
-            self.initial_data.get('ingredients'), instance
-        )
-        instance.save()
-        return instance
+        update_fields = [
+            field for field in ('name', 'text', 'cooking_time')
+            if field in validated_data
+            and getattr(instance, field) != validated_data[field]
+        ]
+        for field in update_fields:
+            setattr(instance, field, validated_data[field])
+        image = validated_data.get('image')
+        if image is not None and self.image_changed(instance.image, image):
+            instance.image = image
+            update_fields.append('image')
+        if (update_fields or 'tags' in validated_data
+                or 'ingredients' in validated_data):
+            # Ингредиенты пишутся пакетно, updated_at обновляется здесь.
+            instance.save(update_fields=[*update_fields, 'updated_at'])
+        if 'tags' in validated_data:
+            instance.tags.set(validated_data['tags'])
+        if 'ingredients' in validated_data:
+            self.update_ingredients(validated_data['ingredients'], instance)
+        return Recipe.objects.for_read(
+            self.context['request'].user
+        ).get(pk=instance.pk)
 
 
 class CartSerializer(serializers.ModelSerializer):
@@ -192,6 +371,28 @@ class FavoriteSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class RecipeIdsSerializer(serializers.Serializer):
+    """Сериализатор списка рецептов для пакетных операций"""
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BATCH_SIZE,
+    )
+
+
+class PantrySerializer(serializers.Serializer):
+    """Параметры поиска рецептов по имеющимся ингредиентам"""
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BATCH_SIZE,
+    )
+    max_cooking_time = serializers.IntegerField(min_value=1, required=False)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=MAX_BATCH_SIZE, default=6
+    )
+
+
 class ShortenedRecipeSerializer(serializers.ModelSerializer):
     """Сокращенный сериализатор рецепта"""
     image = Base64ImageField()
@@ -211,7 +412,9 @@ class FollowSerializer(serializers.ModelSerializer):
     last_name = serializers.ReadOnlyField(source='following.last_name')
     is_subscribed = serializers.SerializerMethodField()
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
+    recipes_count = serializers.ReadOnlyField(
+        source='following.recipes_count'
+    )
 
     class Meta:
         model = User
@@ -228,21 +431,18 @@ class FollowSerializer(serializers.ModelSerializer):
         return obj
 
     def get_is_subscribed(self, obj):
-        return Follow.objects.filter(
-            user=obj.user, following=obj.following
-        ).exists()
+        # Сериализатор получает только существующие подписки.
+        return True
 
     def get_recipes(self, obj):
-        request = self.context.get('request')
-        limit = request.query_params.get('recipes_limit')
-        queryset = Recipe.objects.filter(author=obj.following)
-        if limit:
-            queryset = queryset[:int(limit)]
+        recipes = getattr(obj.following, 'limited_recipes', None)
+        if recipes is None:
+            recipes = Recipe.objects.filter(author=obj.following)
+            limit = get_recipes_limit(self.context.get('request'))
+            if limit is not None:
+                recipes = recipes[:limit]
         return ShortenedRecipeSerializer(
-            queryset,
+            recipes,
             many=True,
             read_only=True
         ).data
-
-    def get_recipes_count(self, obj):
-        return Recipe.objects.filter(author=obj.following).count()
@@ -0,0 +1,59 @@
+import os
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+FONT_NAME = 'nimbussanl'
+FONT_FILE = os.path.join(settings.BASE_DIR, 'nimbussanl_boldcond.ttf')
+TITLE = 'Список ингредиентов'
+TITLE_SIZE = 24
+LINE_SIZE = 16
+LINE_HEIGHT = 25
+TOP = 750
+BOTTOM = 50
+LEFT = 75
+# Больше этого размера PDF сбрасывается из памяти во временный файл.
+SPOOL_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def register_font():
+    """Разбирает TTF-файл один раз на процесс."""
+    pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_FILE, 'UTF-8'))
+
+
+def draw_title(page):
+    page.setFont(FONT_NAME, size=TITLE_SIZE)
+    page.drawString(200, 800, TITLE)
+    page.setFont(FONT_NAME, size=LINE_SIZE)
+
+
+def render_shopping_list(ingredients):
+    """Рисует список покупок постранично и возвращает файл с PDF.
+
+    ingredients - итерируемое из словарей с ключами name,
+    measurement_unit и amount.
+    """
+    register_font()
+    output = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    page = canvas.Canvas(output, pagesize=A4)
+    draw_title(page)
+    height = TOP
+    for i, item in enumerate(ingredients, 1):
+        if height < BOTTOM:
+            page.showPage()
+            page.setFont(FONT_NAME, size=LINE_SIZE)
+            height = TOP + LINE_HEIGHT * 2
+        page.drawString(LEFT, height, (f'<{i}> {item["name"]} - '
+                                       f'{item["amount"]}, '
+                                       f'{item["measurement_unit"]}'))
+        height -= LINE_HEIGHT
+    page.showPage()
+    page.save()
+    output.seek(0)
+    return output
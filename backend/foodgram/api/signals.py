@@ -0,0 +1,62 @@
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_save)
+from django.db.models import Exists, OuterRef
+from django.dispatch import receiver
+
+from recipes.models import (Cart, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, Tag)
+from users.models import Follow, User
+
+from .cache import FRAGMENT_GENERATION_KEY, bump_generation
+from .viewer_state import forget_ids
+
+# Поля автора, которые попадают в представление рецепта.
+AUTHOR_FIELDS = ('email', 'username', 'first_name', 'last_name')
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+@receiver([post_save, post_delete], sender=RecipeIngredient)
+@receiver([post_save, post_delete], sender=Tag)
+@receiver([post_save, post_delete], sender=Ingredient)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_responses(sender, **kwargs):
+    bump_generation()
+
+
+@receiver([post_save, post_delete], sender=Tag)
+@receiver([post_save, post_delete], sender=Ingredient)
+def invalidate_all_fragments(sender, **kwargs):
+    bump_generation(FRAGMENT_GENERATION_KEY)
+
+
+@receiver(pre_save, sender=User)
+def remember_author_fields(sender, instance, update_fields=None, **kwargs):
+    instance._stored_author = None
+    if instance._state.adding or (
+        update_fields is not None
+        and not set(AUTHOR_FIELDS) & set(update_fields)
+    ):
+        return
+    # Пользователь без рецептов в ответах о рецептах не встречается.
+    instance._stored_author = User.objects.filter(
+        Exists(Recipe.objects.filter(author_id=OuterRef('pk'))),
+        pk=instance.pk,
+    ).values(*AUTHOR_FIELDS).first()
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_responses(sender, instance, **kwargs):
+    stored = getattr(instance, '_stored_author', None)
+    if stored and any(
+        getattr(instance, field) != value for field, value in stored.items()
+    ):
+        bump_generation()
+        bump_generation(FRAGMENT_GENERATION_KEY)
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+@receiver([post_save, post_delete], sender=Cart)
+@receiver([post_save, post_delete], sender=Follow)
+def invalidate_viewer_state(sender, instance, **kwargs):
+    # Изменения из админки или каскадом при удалении рецепта.
+    forget_ids([instance.user_id])
@@ -0,0 +1,164 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import serializers, viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from recipes.models import Ingredient, Recipe, RecipeIngredient, Tag, Tombstone
+
+from .permissions import IsAdminOrReadOnly
+from .serializers import IngredientSerializer, TagSerializer
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class SyncTagSerializer(TagSerializer):
+    """Тег для синхронизации"""
+
+    class Meta(TagSerializer.Meta):
+        fields = TagSerializer.Meta.fields + ('updated_at',)
+
+
+class SyncIngredientSerializer(IngredientSerializer):
+    """Ингредиент для синхронизации"""
+
+    class Meta(IngredientSerializer.Meta):
+        fields = IngredientSerializer.Meta.fields + ('updated_at',)
+
+
+class SyncRecipeIngredientSerializer(serializers.ModelSerializer):
+    """Ингредиент рецепта для синхронизации"""
+    id = serializers.ReadOnlyField(source='ingredient_id')
+
+    class Meta:
+        model = RecipeIngredient
+        fields = ('id', 'amount')
+
+
+class SyncRecipeSerializer(serializers.ModelSerializer):
+    """Рецепт для синхронизации: связи передаются идентификаторами"""
+    ingredients = SyncRecipeIngredientSerializer(
+        source='recipe_ingredient', many=True, read_only=True
+    )
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'author', 'tags', 'ingredients', 'name', 'image',
+                  'text', 'cooking_time', 'updated_at')
+
+
+class TombstoneSerializer(serializers.ModelSerializer):
+    """Удаленный объект"""
+    id = serializers.ReadOnlyField(source='object_id')
+
+    class Meta:
+        model = Tombstone
+        fields = ('model', 'id')
+
+
+# Потоки изменений в порядке выдачи: имя, кверисет, поле времени,
+# сериализатор.
+STREAMS = (
+    ('tags', Tag.objects.all(), 'updated_at', SyncTagSerializer),
+    ('ingredients', Ingredient.objects.all(), 'updated_at',
+     SyncIngredientSerializer),
+    ('recipes', Recipe.objects.prefetch_related(
+        'tags', 'recipe_ingredient'
+    ), 'updated_at', SyncRecipeSerializer),
+    ('deleted', Tombstone.objects.all(), 'deleted_at', TombstoneSerializer),
+)
+
+
+def encode_token(positions):
+    data = json.dumps({
+        name: [moment.isoformat(), pk]
+        for name, (moment, pk) in positions.items()
+    }, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    """Позиции потоков {имя: (время, id)} из токена клиента."""
+    positions = {name: (EPOCH, 0) for name, *_ in STREAMS}
+    if not token:
+        return positions
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            token + '=' * (-len(token) % 4)
+        ))
+        # Токен без какого-либо потока выдан не нами: синхронизация с
+        # нуля молча вернула бы клиенту весь каталог.
+        if not isinstance(data, dict):
+            raise TypeError
+        for name in positions:
+            moment, pk = data[name]
+            positions[name] = (datetime.fromisoformat(moment), int(pk))
+    except (ValueError, TypeError, KeyError):
+        raise ValidationError({'since': 'Некорректный токен синхронизации'})
+    return positions
+
+
+def after(field, position):
+    """Строки после позиции в порядке (время, id)."""
+    moment, pk = position
+    return Q(**{f'{field}__gt': moment}) | Q(**{field: moment, 'pk__gt': pk})
+
+
+class SyncViewSet(viewsets.ViewSet):
+    """Изменения каталога после токена синхронизации.
+
+    Ответ содержит не больше limit объектов, новый токен в next и
+    признак has_more. Изменения моложе SYNC_LAG секунд не выдаются,
+    чтобы не пропустить еще не зафиксированные транзакции. Если
+    изменений нет, выполняется один запрос с проверкой индексов.
+    """
+    permission_classes = (IsAdminOrReadOnly,)
+
+    def list(self, request):
+        try:
+            limit = int(request.query_params.get(
+                'limit', settings.SYNC_LIMIT
+            ))
+        except ValueError:
+            raise ValidationError({'limit': 'Укажите число'})
+        positions = decode_token(request.query_params.get('since'))
+        until = timezone.now() - timedelta(seconds=settings.SYNC_LAG)
+        pending = [
+            queryset.filter(
+                after(field, positions[name]), **{f'{field}__lte': until}
+            ).order_by(field, 'pk')
+            for name, queryset, field, _ in STREAMS
+        ]
+        first, *rest = (
+            queryset.order_by().values('pk') for queryset in pending
+        )
+        probe = first.union(*rest, all=True)
+        data = {name: [] for name, *_ in STREAMS}
+        has_more = False
+        if list(probe[:1]):
+            budget = min(max(limit, 1), settings.SYNC_MAX_LIMIT)
+            for (name, _, field, serializer), queryset in zip(STREAMS,
+                                                              pending):
+                if not budget:
+                    has_more = has_more or queryset.exists()
+                    continue
+                rows = list(queryset[:budget + 1])
+                has_more = has_more or len(rows) > budget
+                rows = rows[:budget]
+                if rows:
+                    last = rows[-1]
+                    positions[name] = (getattr(last, field), last.pk)
+                    data[name] = serializer(
+                        rows, many=True, context={'request': request}
+                    ).data
+                budget -= len(rows)
+        return Response({
+            **data,
+            'next': encode_token(positions),
+            'has_more': has_more,
+        })
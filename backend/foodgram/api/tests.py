@@ -0,0 +1,327 @@
+import base64
+import json
+import threading
+from collections import Counter
+from unittest import SkipTest
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase
+from rest_framework.test import APIClient, APITestCase
+
+from recipes.models import (Cart, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingListItem, Tag)
+from users.models import User
+
+RECIPES_COUNT = 12
+PARALLEL_REQUESTS = 8
+# Запросы на страницу списка: поколение представлений, count, рецепты,
+# авторы, теги, ингредиенты.
+LIST_QUERIES = 6
+# Анонимному пользователю еще нужно поколение кэша ответов.
+ANONYMOUS_QUERIES = 1
+# Пользователю еще нужны версия и множества избранного, корзины и
+# подписок.
+VIEWER_QUERIES = 4
+# Правка ингредиентов рецепта: проверка, запись рецепта, тегов,
+# ингредиентов и списков покупок, журнал индекса и рецепт для ответа.
+UPDATE_QUERIES = 17
+
+
+class RecipeListQueriesTest(APITestCase):
+    """Число запросов списка рецептов не зависит от размера страницы"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                email=f'user{number}@example.com',
+                username=f'user{number}',
+                first_name='Имя',
+                last_name='Фамилия',
+                password='password-12345',
+            )
+            for number in range(3)
+        ]
+        tags = [
+            Tag.objects.create(name=f'Тег {number}', slug=f'tag{number}',
+                               color=Tag.BLUE)
+            for number in range(3)
+        ]
+        ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+            for number in range(10)
+        ])
+        for number in range(RECIPES_COUNT):
+            recipe = Recipe.objects.create(
+                author=cls.users[number % 3],
+                name=f'Рецепт {number}',
+                text='Описание',
+                cooking_time=10,
+                image='recipes/images/test.png',
+            )
+            recipe.tags.set(tags[:number % 3 + 1])
+            RecipeIngredient.objects.bulk_create([
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=number + 1)
+                for ingredient in ingredients[number % 5:number % 5 + 4]
+            ])
+
+    def setUp(self):
+        cache.clear()
+
+    def assert_list_queries(self, queries):
+        for limit in (2, 10):
+            with self.subTest(limit=limit):
+                cache.clear()
+                with self.assertNumQueries(queries):
+                    response = self.client.get(
+                        '/api/recipes/', {'limit': limit}
+                    )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), limit)
+
+    def test_anonymous_list(self):
+        self.assert_list_queries(LIST_QUERIES + ANONYMOUS_QUERIES)
+
+    def test_authenticated_list(self):
+        self.client.force_authenticate(self.users[0])
+        self.assert_list_queries(LIST_QUERIES + VIEWER_QUERIES)
+
+    def test_filtered_list(self):
+        """Фильтры - подзапросы EXISTS в том же запросе, без DISTINCT"""
+        user = self.users[0]
+        recipes = Recipe.objects.filter(author=self.users[1]).order_by('id')
+        for recipe in recipes[:3]:
+            Favorite.objects.create(user=user, recipe=recipe)
+            Cart.objects.create(user=user, recipe=recipe)
+        self.client.force_authenticate(user)
+        params = {
+            'limit': 10,
+            'tags': ['tag1', 'tag2'],
+            'author': self.users[1].id,
+            'is_favorited': 1,
+            'is_in_shopping_cart': 1,
+        }
+        expected = sorted(
+            recipe.id for recipe in recipes[:3]
+            if recipe.tags.filter(slug__in=params['tags']).exists()
+        )
+        for search in ('', 'Рецепт'):
+            with self.subTest(search=search):
+                cache.clear()
+                with self.assertNumQueries(
+                    LIST_QUERIES + VIEWER_QUERIES
+                ) as context:
+                    response = self.client.get(
+                        '/api/recipes/', {**params, 'search': search}
+                    )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(sorted(
+                    recipe['id'] for recipe in response.data['results']
+                ), expected)
+                for query in context.captured_queries:
+                    self.assertNotIn('DISTINCT', query['sql'])
+
+    def test_deep_cursor_page(self):
+        """Страница по курсору не считает строки и не пропускает OFFSET"""
+        urls = ['/api/recipes/?pagination=cursor&limit=2']
+        while urls[-1]:
+            urls.append(self.client.get(urls[-1]).data['next'])
+        urls.pop()
+        self.assertEqual(len(urls), RECIPES_COUNT // 2)
+        for url in (urls[0], urls[-1]):
+            cache.clear()
+            with self.assertNumQueries(
+                LIST_QUERIES + ANONYMOUS_QUERIES - 1
+            ) as context:
+                response = self.client.get(url)
+            self.assertEqual(len(response.data['results']), 2)
+            for query in context.captured_queries:
+                self.assertNotIn('COUNT(', query['sql'])
+                self.assertNotIn('OFFSET', query['sql'])
+
+    def test_cache_stats(self):
+        self.client.get('/api/recipes/', {'limit': 2})
+        self.client.get('/api/recipes/', {'limit': 2})
+        self.client.force_authenticate(self.users[0])
+        self.assertEqual(
+            self.client.get('/api/recipes/cache_stats/').status_code, 403
+        )
+        self.users[0].is_staff = True
+        response = self.client.get('/api/recipes/cache_stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.data['hit'], 1)
+
+
+class RecipeUpdateQueriesTest(APITestCase):
+    """Правка рецепта не делает запросов на каждый ингредиент"""
+    INGREDIENTS = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com',
+            username='author',
+            first_name='Имя',
+            last_name='Фамилия',
+            password='password-12345',
+        )
+        cls.tag = Tag.objects.create(name='Тег', slug='tag', color=Tag.BLUE)
+        cls.ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+            for number in range(cls.INGREDIENTS * 2)
+        ])
+
+    def setUp(self):
+        self.recipe = Recipe.objects.create(
+            author=self.author,
+            name='Рецепт',
+            text='Описание',
+            cooking_time=10,
+            image='recipes/images/test.png',
+        )
+        self.recipe.tags.set([self.tag])
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(recipe=self.recipe, ingredient=ingredient,
+                             amount=1)
+            for ingredient in self.ingredients[:self.INGREDIENTS]
+        ])
+        self.client.force_authenticate(self.author)
+
+    def patch(self, amount=1, shift=0):
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.id}/',
+            {
+                'name': 'Рецепт',
+                'text': 'Описание',
+                'cooking_time': 10,
+                'tags': [self.tag.id],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': amount}
+                    for ingredient
+                    in self.ingredients[shift:shift + self.INGREDIENTS]
+                ],
+            },
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_amounts(self):
+        with self.assertNumQueries(UPDATE_QUERIES):
+            self.patch(amount=2)
+
+    def test_replaced_ingredients(self):
+        # Удаление и вставка - по одному запросу на любое число строк.
+        for shift in (5, self.INGREDIENTS):
+            with self.subTest(shift=shift):
+                self.setUp()
+                with self.assertNumQueries(UPDATE_QUERIES + 1):
+                    self.patch(shift=shift)
+
+
+class SyncTokenTest(APITestCase):
+    """Токен синхронизации принимается только в том виде, в каком выдан"""
+
+    def get(self, since):
+        return self.client.get('/api/sync/', {'since': since})
+
+    def test_issued_token(self):
+        Tag.objects.create(name='Тег', slug='tag', color=Tag.BLUE)
+        with self.settings(SYNC_LAG=0):
+            response = self.client.get('/api/sync/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.data['tags'][0]),
+                             {'id', 'name', 'color', 'slug', 'updated_at'})
+            response = self.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['tags'], [])
+
+    def test_malformed_token(self):
+        for data in ([1, 2], {}, {'tags': ['2023-01-01T00:00:00', 0]}, 5):
+            token = base64.urlsafe_b64encode(json.dumps(data).encode())
+            with self.subTest(data=data):
+                self.assertEqual(self.get(token.decode()).status_code, 400)
+        self.assertEqual(self.get('not a token').status_code, 400)
+
+
+class ParallelTogglesTest(TransactionTestCase):
+    """Одновременные повторы добавления не дублируют связи и счетчики"""
+
+    @classmethod
+    def setUpClass(cls):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise SkipTest('Нужна база, доступная из нескольких потоков')
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+        self.author, self.user = (
+            User.objects.create_user(
+                email=f'{name}@example.com',
+                username=name,
+                first_name='Имя',
+                last_name='Фамилия',
+                password='password-12345',
+            )
+            for name in ('author', 'reader')
+        )
+        ingredient = Ingredient.objects.create(name='Мука',
+                                               measurement_unit='г')
+        self.recipe = Recipe.objects.create(
+            author=self.author,
+            name='Рецепт',
+            text='Описание',
+            cooking_time=10,
+            image='recipes/images/test.png',
+        )
+        RecipeIngredient.objects.create(recipe=self.recipe,
+                                        ingredient=ingredient, amount=100)
+
+    def post_in_parallel(self, url):
+        barrier = threading.Barrier(PARALLEL_REQUESTS)
+        statuses = []
+
+        def send():
+            client = APIClient(raise_request_exception=False)
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                statuses.append(client.post(url).status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=send)
+                   for _ in range(PARALLEL_REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return Counter(statuses)
+
+    def test_favorite(self):
+        statuses = self.post_in_parallel(
+            f'/api/recipes/{self.recipe.id}/favorite/'
+        )
+        self.assertEqual(statuses, {201: 1, 400: PARALLEL_REQUESTS - 1})
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 1)
+
+    def test_shopping_cart(self):
+        statuses = self.post_in_parallel(
+            f'/api/recipes/{self.recipe.id}/shopping_cart/'
+        )
+        self.assertEqual(statuses, {201: 1, 400: PARALLEL_REQUESTS - 1})
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.carts_count, 1)
+        self.assertEqual(list(ShoppingListItem.objects.filter(
+            user=self.user
+        ).values_list('amount', flat=True)), [100])
+
+    def test_subscribe(self):
+        statuses = self.post_in_parallel(
+            f'/api/users/{self.author.id}/subscribe/'
+        )
+        self.assertEqual(statuses, {201: 1, 400: PARALLEL_REQUESTS - 1})
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followers_count, 1)
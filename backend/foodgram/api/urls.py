@@ -1,12 +1,14 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from .sync import SyncViewSet
 from .views import IngredientViewset, RecipeViewset, TagViewset
 
 router = DefaultRouter()
 router.register('tags', TagViewset, basename='tags')
 router.register('ingredients', IngredientViewset, basename='ingredients')
 router.register('recipes', RecipeViewset, basename='recipes')
+router.register('sync', SyncViewSet, basename='sync')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,13 +1,15 @@
 # isort: skip_file
-from django.http import HttpResponse
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import FileResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import get_object_or_404
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
 from recipes.models import (
@@ -15,19 +17,43 @@ from recipes.models import (
     Favorite,
     Ingredient,
     Recipe,
-    RecipeIngredient,
-    Tag
+    ShoppingListItem,
+    Tag,
+    shift_counter
+)
+from foodgram.toggles import (
+    add_relation,
+    add_relations,
+    parse_id,
+    remove_relation,
+    remove_relations
 )
+from foodgram.utils import MAX_BATCH_SIZE
+from recipes.feed import feed_filter
+from recipes.ingredient_index import ingredient_index
+from recipes.pantry_index import mark_changed, pantry_index
 
-from .filters import IngredientSearchFilter
+from .cache import (
+    bump_generation,
+    cache_anonymous_response,
+    current_generation,
+    metrics
+)
+from .filters import AuthorAndTagFilter, IngredientSearchFilter
 from .pagination import LimitPageNumberPagination
 from .permissions import IsAdminOrReadOnly, IsOwnerOrReadOnly
 from .serializers import (
     IngredientSerializer,
     CreateRecipeSerializer,
+    PantrySerializer,
+    RecipeIdsSerializer,
     ShortenedRecipeSerializer,
     TagSerializer
 )
+from .shopping_list import render_shopping_list
+from .viewer_state import forget_ids
+
+SIMILAR_LIMIT = 10
 
 
 class TagViewset(viewsets.ModelViewSet):
@@ -47,43 +73,69 @@ class IngredientViewset(viewsets.ModelViewSet):
     search_fields = ('^name',)
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        if not settings.INGREDIENT_INDEX_IN_MEMORY:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_index.search(
+            request.query_params.get(IngredientSearchFilter.search_param, '')
+        ))
+
 
 class RecipeViewset(viewsets.ModelViewSet):
     """Вьюсет рецепта"""
-    queryset = Recipe.objects.all().distinct()
+    queryset = Recipe.objects.all()
     serializer_class = CreateRecipeSerializer
     pagination_class = LimitPageNumberPagination
     filter_backends = [DjangoFilterBackend]
-#    filter_class = AuthorAndTagFilter
+    filterset_class = AuthorAndTagFilter
     permission_classes = [IsOwnerOrReadOnly]
 
-    def get_queryset(self):
-        queryset = Recipe.objects.all()
-        tags = self.request.query_params.getlist('tags')
-        user = self.request.user
-        author = self.request.query_params.get('author')
-        is_favorite = self.request.query_params.get('is_favorited')
-        is_in_shopping_cart = self.request.query_params.get(
-            'is_in_shopping_cart'
-        )
+    def get_fields(self):
+        """Поля из параметра fields для чтения или None - все поля."""
+        fields = self.request.query_params.get('fields')
+        if self.action not in ('list', 'retrieve') or not fields:
+            return None
+        return {field.strip() for field in fields.split(',')}
 
-        if author:
-            queryset = queryset.filter(author_id=author)
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_fields()
+        context['fragments'] = self.use_fragments()
+        return context
 
-        if tags:
-            queryset = queryset.filter(tags__slug__in=tags).distinct()
+    def use_fragments(self):
+        """Список без выборки полей собирается из кэша представлений."""
+        return (
+            self.action in ('list', 'pantry', 'feed')
+            and self.get_fields() is None
+        )
 
-        if is_favorite:
-            queryset = queryset.filter(favorites__user=user)
+    def get_queryset(self):
+        # Флаги пользователя отвечает api.viewer_state без подзапросов.
+        if self.use_fragments():
+            return Recipe.objects.all()
+        return Recipe.objects.for_read(
+            self.request.user, self.get_fields(), flags=False
+        )
 
-        if is_in_shopping_cart:
-            queryset = Recipe.objects.filter(cart__user=user)
+    @cache_anonymous_response
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
-        return queryset
+    @cache_anonymous_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @transaction.atomic
+    def perform_update(self, serializer):
+        serializer.save()
+        # Ингредиенты обновляются пакетно, без сигналов моделей.
+        bump_generation()
+        mark_changed([serializer.instance.id])
+
     @action(detail=True, methods=['post', 'delete'],
             permission_classes=[IsAuthenticated])
     def favorite(self, request, pk=None):
@@ -93,63 +145,196 @@ class RecipeViewset(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post', 'delete'],
             permission_classes=[IsAuthenticated])
+    @transaction.atomic
     def shopping_cart(self, request, pk=None):
         if request.method == 'POST':
-            return self.add_obj(Cart, request.user, pk)
-        return self.delete_obj(Cart, request.user, pk)
+            response = self.add_obj(Cart, request.user, pk)
+            if response.status_code == status.HTTP_201_CREATED:
+                ShoppingListItem.objects.add_recipe(request.user.id, pk)
+            return response
+        response = self.delete_obj(Cart, request.user, pk)
+        if response.status_code == status.HTTP_204_NO_CONTENT:
+            ShoppingListItem.objects.remove_recipe(request.user.id, pk)
+        return response
+
+    @action(detail=False, methods=['post', 'delete'], url_path='favorite',
+            url_name='favorite-batch', permission_classes=[IsAuthenticated])
+    def favorite_batch(self, request):
+        return self.batch_obj(Favorite, request)[1]
+
+    @action(detail=False, methods=['post', 'delete'],
+            url_path='shopping_cart', url_name='shopping-cart-batch',
+            permission_classes=[IsAuthenticated])
+    @transaction.atomic
+    def shopping_cart_batch(self, request):
+        changed, response = self.batch_obj(Cart, request)
+        if request.method == 'POST':
+            ShoppingListItem.objects.add_recipes(request.user.id, changed)
+        else:
+            ShoppingListItem.objects.remove_recipes(request.user.id, changed)
+        return response
+
+    @action(detail=False, methods=['get'],
+            permission_classes=[IsAuthenticated])
+    def feed(self, request):
+        """Новые рецепты авторов, на которых подписан пользователь."""
+        queryset = self.filter_queryset(
+            self.get_queryset().filter(feed_filter(request.user))
+        ).order_by('-id')
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(self.get_serializer(queryset, many=True).data)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """Похожие рецепты, рассчитанные build_similar_recipes."""
+        try:
+            limit = min(int(request.query_params['limit']), MAX_BATCH_SIZE)
+        except (KeyError, ValueError):
+            limit = SIMILAR_LIMIT
+        recipes = Recipe.objects.filter(
+            similar_to__recipe_id=parse_id(pk)
+        ).only(
+            'id', 'name', 'image', 'cooking_time'
+        ).order_by('-similar_to__score')[:max(limit, 0)]
+        return Response(ShortenedRecipeSerializer(recipes, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def pantry(self, request):
+        """Рецепты из имеющихся ингредиентов, по убыванию покрытия.
+
+        Кандидатов ранжирует обратный индекс, остальные фильтры
+        (теги, автор, поиск) применяются к ним в базе. Если после
+        фильтров рецептов не хватает, из того же ранжирования берется
+        больше кандидатов.
+        """
+        params = request.query_params
+        serializer = PantrySerializer(data={
+            'ingredients': [
+                pk for value in params.getlist('ingredients')
+                for pk in value.split(',') if pk.strip()
+            ],
+            **{
+                name: params[name]
+                for name in ('max_cooking_time', 'limit') if name in params
+            },
+        })
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        limit = data['limit']
+        ranking = pantry_index.rank(
+            data['ingredients'], data.get('max_cooking_time')
+        )
+        size = limit * 4
+        while True:
+            ranked = ranking.top(size)
+            recipes = self.filter_queryset(self.get_queryset().filter(
+                id__in=[recipe_id for _, recipe_id in ranked]
+            )).in_bulk()
+            picked = [
+                (coverage, recipes[recipe_id])
+                for coverage, recipe_id in ranked if recipe_id in recipes
+            ][:limit]
+            if len(picked) == limit or len(ranked) < size:
+                break
+            size *= 4
+        results = self.get_serializer(
+            [recipe for _, recipe in picked], many=True
+        ).data
+        for item, (coverage, _) in zip(results, picked):
+            item['coverage'] = round(coverage, 3)
+        return Response(results)
 
     @action(detail=False, methods=['get'],
             permission_classes=[IsAuthenticated])
     def download_shopping_cart(self, request):
-        final_list = {}
-        ingredients = RecipeIngredient.objects.filter(
-            recipe__cart__user=request.user).values_list(
-            'ingredient__name', 'ingredient__measurement_unit',
-            'amount')
-        for name, unit, amount in ingredients:
-            if name not in final_list:
-                final_list[name] = {
-                    'measurement_unit': unit,
-                    'amount': amount
-                }
-            else:
-                final_list[name]['amount'] += amount
-        pdfmetrics.registerFont(
-            TTFont(
-                'nimbussanl', 'nimbussanl_boldcond.ttf', 'UTF-8'
-            )
+        ingredients = ShoppingListItem.objects.filter(
+            user=request.user
+        ).values(
+            'amount',
+            name=F('ingredient__name'),
+            measurement_unit=F('ingredient__measurement_unit'),
+        ).order_by('name', 'measurement_unit')
+        return FileResponse(
+            render_shopping_list(ingredients.iterator()),
+            as_attachment=True,
+            filename='shopping_list.pdf',
+            content_type='application/pdf',
         )
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = ('attachment; '
-                                           'filename="shopping_list.pdf"')
-        page = canvas.Canvas(response)
-        page.setFont('nimbussanl', size=24)
-        page.drawString(200, 800, 'Список ингредиентов')
-        page.setFont('nimbussanl', size=16)
-        height = 750
-        for i, (name, data) in enumerate(final_list.items(), 1):
-            page.drawString(75, height, (f'<{i}> {name} - {data["amount"]}, '
-                                         f'{data["measurement_unit"]}'))
-            height -= 25
-        page.showPage()
-        page.save()
-        return response
 
+    @action(detail=False, methods=['get'],
+            permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        """Попадания в кэш анонимных ответов в этом процессе."""
+        hit, miss = metrics['hit'], metrics['miss']
+        return Response({
+            'pid': os.getpid(),
+            'hit': hit,
+            'miss': miss,
+            'hit_ratio': round(hit / (hit + miss), 3) if hit + miss else None,
+            'generation': current_generation(),
+        })
+
+    @transaction.atomic
     def add_obj(self, model, user, pk):
-        if model.objects.filter(user=user, recipe__id=pk).exists():
+        pk = parse_id(pk)
+        if add_relation(model, user.id, 'recipe', pk) is None:
+            get_object_or_404(Recipe, id=pk)
             return Response({
                 'errors': 'Рецепт уже добавлен в список'
             }, status=status.HTTP_400_BAD_REQUEST)
-        recipe = get_object_or_404(Recipe, id=pk)
-        model.objects.create(user=user, recipe=recipe)
+        shift_counter(Recipe.objects.filter(id=pk), model.counter_field, 1)
+        forget_ids([user.id])
+        recipe = Recipe.objects.only(
+            'id', 'name', 'image', 'cooking_time'
+        ).get(id=pk)
         serializer = ShortenedRecipeSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @transaction.atomic
     def delete_obj(self, model, user, pk):
-        obj = model.objects.filter(user=user, recipe__id=pk)
-        if obj.exists():
-            obj.delete()
+        pk = parse_id(pk)
+        if remove_relation(model, user.id, 'recipe', pk):
+            shift_counter(Recipe.objects.filter(id=pk),
+                          model.counter_field, -1)
+            forget_ids([user.id])
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({
             'errors': 'Рецепт уже удален'
         }, status=status.HTTP_400_BAD_REQUEST)
+
+    @transaction.atomic
+    def batch_obj(self, model, request):
+        """Добавляет или удаляет рецепты списком, ответ - статус каждого."""
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        user_id = request.user.id
+        if request.method == 'POST':
+            changed = add_relations(model, user_id, 'recipe', ids)
+            found = set()
+            if len(changed) < len(ids):
+                found = set(Recipe.objects.filter(
+                    id__in=ids
+                ).values_list('id', flat=True))
+            statuses = {
+                pk: 'added' if pk in changed
+                else 'exists' if pk in found else 'not_found'
+                for pk in ids
+            }
+            delta = 1
+        else:
+            changed = remove_relations(model, user_id, 'recipe', ids)
+            statuses = {
+                pk: 'removed' if pk in changed else 'absent' for pk in ids
+            }
+            delta = -1
+        if changed:
+            shift_counter(Recipe.objects.filter(id__in=changed),
+                          model.counter_field, delta)
+            forget_ids([user_id])
+        return changed, Response({'results': [
+            {'id': pk, 'status': statuses[pk]} for pk in ids
+        ]})
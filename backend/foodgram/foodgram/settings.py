@@ -87,6 +87,36 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': getenv('CACHE_LOCATION', default=''),
+    }
+}
+
+# Время жизни закэшированных ответов со списками и рецептами, сек.
+RECIPE_CACHE_TIMEOUT = int(getenv('RECIPE_CACHE_TIMEOUT', default=300))
+# Время жизни представлений отдельных рецептов без данных пользователя.
+RECIPE_FRAGMENT_TIMEOUT = int(
+    getenv('RECIPE_FRAGMENT_TIMEOUT', default=24 * 60 * 60)
+)
+# Время жизни множеств избранного, корзины и подписок пользователя.
+VIEWER_STATE_TIMEOUT = int(
+    getenv('VIEWER_STATE_TIMEOUT', default=24 * 60 * 60)
+)
+
+
+# Кэш аутентификации по токену: размер LRU в процессе, время жизни
+# записей в нем и в общем кэше (сек.), алиас общего кэша ('' - без него;
+# кэш в памяти процесса, например LocMemCache, не используется).
+TOKEN_CACHE_SIZE = int(getenv('TOKEN_CACHE_SIZE', default=1024))
+TOKEN_CACHE_LOCAL_TTL = int(getenv('TOKEN_CACHE_LOCAL_TTL', default=5))
+TOKEN_CACHE_TTL = int(getenv('TOKEN_CACHE_TTL', default=300))
+TOKEN_CACHE_ALIAS = getenv('TOKEN_CACHE_ALIAS', default='default')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -111,7 +141,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'users.authentication.CachedTokenAuthentication',
     ],
 }
 
@@ -153,3 +183,38 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 AUTH_USER_MODEL = 'users.User'
+
+# Поиск ингредиентов по индексу в памяти процесса. Для очень больших
+# каталогов отключите, чтобы искать ранжированным запросом к базе.
+INGREDIENT_INDEX_IN_MEMORY = getenv(
+    'INGREDIENT_INDEX_IN_MEMORY', default='True'
+) == 'True'
+# Как часто процесс сверяет версию индекса с базой, сек.
+INGREDIENT_INDEX_CHECK_INTERVAL = int(
+    getenv('INGREDIENT_INDEX_CHECK_INTERVAL', default=5)
+)
+
+# Индекс поиска по имеющимся ингредиентам: как часто процесс читает
+# журнал изменений и перестраивает снимок в фоне, сек.
+PANTRY_INDEX_CHECK_INTERVAL = int(
+    getenv('PANTRY_INDEX_CHECK_INTERVAL', default=1)
+)
+PANTRY_INDEX_REBUILD_INTERVAL = int(
+    getenv('PANTRY_INDEX_REBUILD_INTERVAL', default=60 * 60)
+)
+
+# Лента подписок: авторы с большим числом подписчиков не рассылаются
+# по лентам, их рецепты подмешиваются при чтении.
+FEED_FANOUT_LIMIT = int(getenv('FEED_FANOUT_LIMIT', default=10000))
+FEED_FANOUT_BATCH = int(getenv('FEED_FANOUT_BATCH', default=1000))
+FEED_BACKFILL = int(getenv('FEED_BACKFILL', default=50))
+# Рассылать в отдельном потоке после коммита, иначе - в том же запросе.
+FEED_FANOUT_IN_THREAD = getenv(
+    'FEED_FANOUT_IN_THREAD', default='True'
+) == 'True'
+
+# Синхронизация каталога: изменения моложе SYNC_LAG секунд не выдаются,
+# чтобы не пропустить транзакции, которые еще не зафиксированы.
+SYNC_LAG = int(getenv('SYNC_LAG', default=2))
+SYNC_LIMIT = int(getenv('SYNC_LIMIT', default=500))
+SYNC_MAX_LIMIT = int(getenv('SYNC_MAX_LIMIT', default=1000))
@@ -0,0 +1,93 @@
+from django.db import connections, router
+from django.http import Http404
+
+
+def parse_id(value):
+    """Идентификатор из URL или 404, если это не число."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise Http404
+
+
+def add_relation(model, user_id, field, target_id):
+    """Связывает пользователя с объектом одним запросом.
+
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING не падает
+    на уникальном ограничении при параллельных запросах. Возвращает id
+    новой строки или None, если связь уже есть или объекта нет.
+    """
+    rows = insert_relations(model, user_id, field, [target_id])
+    return rows[0][0] if rows else None
+
+
+def add_relations(model, user_id, field, target_ids):
+    """Как add_relation для многих объектов, возвращает добавленные id."""
+    return {
+        target for _, target
+        in insert_relations(model, user_id, field, target_ids)
+    }
+
+
+def remove_relation(model, user_id, field, target_id):
+    """Удаляет связь одним запросом, True - если она была."""
+    return bool(remove_relations(model, user_id, field, [target_id]))
+
+
+def remove_relations(model, user_id, field, target_ids):
+    """Удаляет связи одним запросом, возвращает удаленные id объектов."""
+    if not target_ids:
+        return set()
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    opts = model._meta
+    target = quote(opts.get_field(field).column)
+    placeholders = ', '.join(['%s'] * len(target_ids))
+    sql = (
+        f'DELETE FROM {quote(opts.db_table)} '
+        f'WHERE {quote(opts.get_field("user").column)} = %s '
+        f'AND {target} IN ({placeholders}) '
+        f'RETURNING {target}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user_id, *target_ids])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def insert_relations(model, user_id, field, target_ids):
+    if not target_ids:
+        return []
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    opts = model._meta
+    target = opts.get_field(field)
+    related = target.related_model._meta
+    related_pk = quote(related.pk.column)
+    # Значения по умолчанию (например, время создания) задает Django,
+    # а не база, поэтому они передаются в запрос явно.
+    defaults = [
+        model_field for model_field in opts.concrete_fields
+        if model_field.has_default() and not model_field.primary_key
+    ]
+    columns = ', '.join(
+        quote(model_field.column)
+        for model_field in [opts.get_field('user'), target, *defaults]
+    )
+    values = ''.join(', %s' for _ in defaults)
+    placeholders = ', '.join(['%s'] * len(target_ids))
+    sql = (
+        f'INSERT INTO {quote(opts.db_table)} ({columns}) '
+        f'SELECT %s, {related_pk}{values} FROM {quote(related.db_table)} '
+        f'WHERE {related_pk} IN ({placeholders}) '
+        f'ON CONFLICT DO NOTHING '
+        f'RETURNING {quote(opts.pk.column)}, {quote(target.column)}'
+    )
+    params = [
+        user_id,
+        *(model_field.get_db_prep_save(model_field.get_default(), connection)
+          for model_field in defaults),
+        *target_ids,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
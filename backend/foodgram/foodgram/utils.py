@@ -2,8 +2,38 @@ from rest_framework.serializers import ValidationError
 
 LOW_INGREDIENT_LIMIT = 1
 LOW_COOKING_LIMIT = 1
+MAX_BATCH_SIZE = 100
+
+
+class DerivedFieldsMixin:
+    """Исключает из обычного save() поля, которые меняются через update().
+
+    Счетчики и другие производные поля обновляются запросами с F(), а
+    save() устаревшего экземпляра иначе записал бы их старые значения.
+    """
+    derived_fields = ()
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None and not self._state.adding:
+            skipped = {*self.derived_fields, *self.get_deferred_fields()}
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in skipped
+                and field.attname not in skipped
+            ]
+        super().save(*args, update_fields=update_fields, **kwargs)
 
 
 def is_greater_than_zero(value, error):
     if value < 1:
         raise ValidationError(error)
+
+
+def get_recipes_limit(request):
+    """Значение recipes_limit из запроса или None, если оно не задано."""
+    try:
+        limit = int(request.query_params.get('recipes_limit'))
+    except (TypeError, ValueError):
+        return None
+    return limit if limit >= 0 else None
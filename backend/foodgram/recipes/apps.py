@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class RecipesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'recipes'
+
+    def ready(self):
+        from recipes.signals import (create_recipe_search,
+                                     create_relation_indexes,
+                                     create_search_indexes,
+                                     fill_shopping_lists)
+        post_migrate.connect(create_search_indexes, sender=self)
+        post_migrate.connect(create_relation_indexes, sender=self)
+        post_migrate.connect(create_recipe_search, sender=self)
+        post_migrate.connect(fill_shopping_lists, sender=self)
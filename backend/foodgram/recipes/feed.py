@@ -0,0 +1,127 @@
+"""Лента подписок с рассылкой рецептов при публикации.
+
+Новый рецепт пачками по FEED_FANOUT_BATCH подписок записывается в
+FeedEntry подписчиков. Рассылка идет в отдельном потоке после коммита,
+прогресс хранится в FeedFanout, поэтому прерванные рассылки дорабатывает
+команда process_feed. Рецепты авторов, у которых подписчиков больше
+FEED_FANOUT_LIMIT, не рассылаются, а подмешиваются при чтении ленты;
+когда автор возвращается под порог, его последние рецепты рассылаются.
+"""
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+
+from users.models import Follow, User
+
+from .models import FeedEntry, FeedFanout, Recipe
+
+
+def popular_authors():
+    return User.objects.filter(
+        followers_count__gt=settings.FEED_FANOUT_LIMIT
+    )
+
+
+def run_fanout(fanout):
+    """Рассылает рецепт оставшимся подписчикам автора."""
+    recipe = fanout.recipe
+    if popular_authors().filter(pk=recipe.author_id).exists():
+        fanout.delete()
+        return
+    while True:
+        follows = list(Follow.objects.filter(
+            following_id=recipe.author_id, id__gt=fanout.last_follow_id
+        ).order_by('id').values_list(
+            'id', 'user_id'
+        )[:settings.FEED_FANOUT_BATCH])
+        if not follows:
+            fanout.delete()
+            return
+        with transaction.atomic():
+            FeedEntry.objects.bulk_create(
+                [FeedEntry(user_id=user_id, recipe_id=recipe.id)
+                 for _, user_id in follows],
+                ignore_conflicts=True,
+            )
+            fanout.last_follow_id = follows[-1][0]
+            fanout.save(update_fields=['last_follow_id'])
+
+
+def run_in_thread(fanout_ids):
+    try:
+        for fanout in FeedFanout.objects.select_related(
+            'recipe'
+        ).filter(pk__in=fanout_ids).order_by('pk'):
+            run_fanout(fanout)
+    finally:
+        connection.close()
+
+
+def schedule_fanout(*recipes):
+    """Запускает рассылку рецептов после коммита."""
+    fanouts = [FeedFanout.objects.create(recipe=recipe) for recipe in recipes]
+
+    def start():
+        if settings.FEED_FANOUT_IN_THREAD:
+            threading.Thread(
+                target=run_in_thread,
+                args=([fanout.pk for fanout in fanouts],),
+                daemon=True,
+            ).start()
+        else:
+            for fanout in fanouts:
+                run_fanout(fanout)
+
+    if fanouts:
+        transaction.on_commit(start)
+
+
+def unfollowed(author_id):
+    """Рассылает последние рецепты автора, вернувшегося под порог.
+
+    Пока у автора больше FEED_FANOUT_LIMIT подписчиков, его рецепты не
+    рассылаются, а подмешиваются при чтении. Когда отписка опускает
+    автора до порога, они пропали бы из лент, поэтому последние
+    FEED_BACKFILL рецептов рассылаются заново. Вызывается после
+    уменьшения followers_count в той же транзакции.
+    """
+    if not User.objects.filter(
+        pk=author_id, followers_count=settings.FEED_FANOUT_LIMIT
+    ).exists():
+        return
+    schedule_fanout(*Recipe.objects.filter(
+        author_id=author_id
+    ).order_by('-id')[:settings.FEED_BACKFILL])
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту последние рецепты автора при подписке."""
+    if popular_authors().filter(pk=author_id).exists():
+        return
+    recipe_ids = Recipe.objects.filter(
+        author_id=author_id
+    ).order_by('-id').values_list('id', flat=True)[:settings.FEED_BACKFILL]
+    FeedEntry.objects.bulk_create(
+        [FeedEntry(user_id=user_id, recipe_id=recipe_id)
+         for recipe_id in recipe_ids],
+        ignore_conflicts=True,
+    )
+
+
+def cleanup(user_id, author_id):
+    """Убирает из ленты рецепты автора при отписке."""
+    FeedEntry.objects.filter(
+        user_id=user_id, recipe__author_id=author_id
+    ).delete()
+
+
+def feed_filter(user):
+    """Условие на рецепты ленты: записи FeedEntry и популярные авторы."""
+    return Q(Exists(FeedEntry.objects.filter(
+        user_id=user.id, recipe_id=OuterRef('pk')
+    ))) | Q(author__in=Follow.objects.filter(
+        user_id=user.id,
+        following__followers_count__gt=settings.FEED_FANOUT_LIMIT,
+    ).values('following_id'))
@@ -0,0 +1,76 @@
+import threading
+from bisect import bisect_left
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Ingredient
+from .versions import bump_version, get_version
+
+# Версия каталога хранится в базе: сброс из manage.py load_ingredients
+# должен дойти до процессов веб-сервера.
+VERSION_KEY = 'ingredient_index_version'
+
+
+def current_version():
+    return get_version(VERSION_KEY)
+
+
+def invalidate():
+    """Сбрасывает индекс во всех процессах."""
+    bump_version(VERSION_KEY)
+    transaction.on_commit(ingredient_index.expire)
+
+
+class IngredientIndex:
+    """Индекс названий ингредиентов в памяти процесса.
+
+    Строки отсортированы по названию в нижнем регистре, поэтому
+    совпадения по префиксу находятся двоичным поиском. Индекс
+    строится лениво и перестраивается, когда меняется версия в базе.
+    Версия проверяется не чаще раза в INGREDIENT_INDEX_CHECK_INTERVAL
+    секунд, изменения в своем процессе видны сразу.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = (None, [], [])
+        self.checked = 0
+
+    def expire(self):
+        self.checked = 0
+
+    def load(self):
+        if monotonic() < self.checked and self.state[0] is not None:
+            return self.state[1], self.state[2]
+        version = current_version()
+        self.checked = monotonic() + settings.INGREDIENT_INDEX_CHECK_INTERVAL
+        if self.state[0] != version:
+            with self.lock:
+                if self.state[0] != version:
+                    items = sorted(
+                        Ingredient.objects.values(
+                            'id', 'name', 'measurement_unit'
+                        ).order_by(),
+                        key=lambda item: (item['name'].lower(), item['id'])
+                    )
+                    keys = [item['name'].lower() for item in items]
+                    self.state = (version, keys, items)
+        return self.state[1], self.state[2]
+
+    def search(self, query=''):
+        """Сначала совпадения по префиксу, затем по подстроке."""
+        keys, items = self.load()
+        query = query.lower()
+        if not query:
+            return list(items)
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query + '\U0010ffff', start)
+        return items[start:end] + [
+            item for key, item in zip(keys, items)
+            if query in key and not key.startswith(query)
+        ]
+
+
+ingredient_index = IngredientIndex()
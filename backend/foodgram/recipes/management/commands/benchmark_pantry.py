@@ -0,0 +1,77 @@
+from statistics import median
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from recipes.pantry_index import Snapshot, State
+
+
+def synthetic_catalog(recipes, ingredients, per_recipe, seed):
+    """Рецепты и пары (рецепт, ингредиент) с частотой ингредиентов по Ципфу.
+
+    Как в настоящем каталоге, соль и масло входят в большую часть
+    рецептов, а редкие ингредиенты - в единицы.
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, ingredients + 1)
+    weights /= weights.sum()
+    recipe_ids = np.arange(1, recipes + 1)
+    pairs = np.column_stack([
+        np.repeat(recipe_ids, per_recipe),
+        rng.choice(ingredients, size=recipes * per_recipe, p=weights) + 1,
+    ])
+    pairs = np.unique(pairs, axis=0)
+    catalog = np.column_stack([recipe_ids, rng.integers(1, 180, recipes)])
+    return catalog, pairs, weights, rng
+
+
+class Command(BaseCommand):
+    """Замер поиска рецептов по имеющимся ингредиентам"""
+    help = ('Строит индекс по синтетическому каталогу в памяти и замеряет '
+            'время ранжирования запросов к нему')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=1000000)
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument(
+            '--per-recipe', type=int, default=8,
+            help='Ингредиентов в рецепте',
+        )
+        parser.add_argument(
+            '--pantry', type=int, default=15,
+            help='Ингредиентов в запросе',
+        )
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        catalog, pairs, weights, rng = synthetic_catalog(
+            options['recipes'], options['ingredients'],
+            options['per_recipe'], options['seed'],
+        )
+        start = perf_counter()
+        state = State(Snapshot(catalog, pairs))
+        self.stdout.write(
+            f'Снимок: {len(catalog)} рецептов, {len(pairs)} связей, '
+            f'{(perf_counter() - start) * 1000:.0f} мс'
+        )
+        timings = []
+        candidates = 0
+        for _ in range(options['queries']):
+            pantry = rng.choice(
+                options['ingredients'], size=options['pantry'],
+                replace=False, p=weights,
+            ) + 1
+            start = perf_counter()
+            ranking = state.rank(pantry.tolist())
+            ranking.top(options['limit'])
+            timings.append(perf_counter() - start)
+            candidates += len(ranking)
+        timings.sort()
+        self.stdout.write(
+            f'Запрос: медиана {median(timings) * 1000:.1f} мс, '
+            f'p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} мс, '
+            f'в среднем {candidates // len(timings)} кандидатов'
+        )
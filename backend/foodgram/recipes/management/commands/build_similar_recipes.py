@@ -0,0 +1,162 @@
+import heapq
+import resource
+from array import array
+from collections import Counter
+from math import sqrt
+from time import monotonic
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from recipes.models import (Cart, Favorite, Recipe, SimilarityState,
+                            SimilarRecipe)
+
+INTERACTION_MODELS = (Favorite, Cart)
+
+
+def interaction_rows(model):
+    return model.objects.values_list(
+        'user_id', 'recipe_id'
+    ).order_by('user_id', 'recipe_id').iterator(chunk_size=10000)
+
+
+def load_interactions():
+    """Разреженная матрица пользователь x рецепт в двух направлениях.
+
+    Строки избранного и корзины идут в порядке (user_id, recipe_id) по
+    уникальным индексам и сразу пишутся в массивы array('I'), без
+    промежуточных множеств: память - около 8 байт на взаимодействие.
+    """
+    user_items = {}
+    item_users = {}
+    last = None
+    for row in heapq.merge(*map(interaction_rows, INTERACTION_MODELS)):
+        if row == last:
+            continue
+        last = row
+        user_id, recipe_id = row
+        items = user_items.get(user_id)
+        if items is None:
+            items = user_items[user_id] = array('I')
+        items.append(recipe_id)
+        users = item_users.get(recipe_id)
+        if users is None:
+            users = item_users[recipe_id] = array('I')
+        users.append(user_id)
+    return user_items, item_users
+
+
+def chunks(queryset, size):
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:size])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield rows
+
+
+class Command(BaseCommand):
+    """Расчет похожих рецептов"""
+    help = ('Считает похожие рецепты по совместному избранному и спискам '
+            'покупок, по умолчанию только для рецептов, у которых они '
+            'изменились с прошлого запуска')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Пересчитать все рецепты',
+        )
+        parser.add_argument(
+            '--top', type=int, default=20,
+            help='Сколько похожих рецептов хранить для каждого',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Сколько рецептов считать и записывать за раз',
+        )
+        parser.add_argument(
+            '--max-user-items', type=int, default=500,
+            help='Не учитывать пользователей с большим числом рецептов',
+        )
+        parser.add_argument(
+            '--min-common', type=int, default=1,
+            help='Минимум общих пользователей у похожих рецептов',
+        )
+
+    def handle(self, *args, **options):
+        started = monotonic()
+        self.options = options
+        self.computed_at = timezone.now()
+        self.user_items, self.item_users = load_interactions()
+        recipes = Recipe.objects.annotate(
+            total=F('favorites_count') + F('carts_count')
+        )
+        if not options['full']:
+            # Взаимодействия удалялись (изменилось их число) или
+            # добавлялись после прошлого расчета.
+            recipes = recipes.filter(
+                Q(similarity_state__isnull=True, total__gt=0)
+                | Q(similarity_state__interactions__lt=F('total'))
+                | Q(similarity_state__interactions__gt=F('total'))
+                | Q(*(
+                    Exists(model.objects.filter(
+                        recipe_id=OuterRef('pk'),
+                        created_at__gt=OuterRef(
+                            'similarity_state__computed_at'
+                        ),
+                    ))
+                    for model in INTERACTION_MODELS
+                ), _connector=Q.OR)
+            )
+        processed = stored = 0
+        for rows in chunks(recipes.values_list('pk', 'total'),
+                           options['chunk_size']):
+            stored += self.store(rows)
+            processed += len(rows)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f'Рецептов: {processed}, похожих: {stored}, '
+            f'время: {monotonic() - started:.2f} с, '
+            f'пик памяти: {peak:.0f} МБ'
+        ))
+
+    def neighbours(self, recipe_id):
+        """Лучшие по косинусной мере рецепты с общими пользователями."""
+        users = self.item_users.get(recipe_id)
+        if not users:
+            return []
+        common = Counter()
+        for user_id in users:
+            items = self.user_items[user_id]
+            if len(items) <= self.options['max_user_items']:
+                common.update(items)
+        common.pop(recipe_id, None)
+        size = len(users)
+        return heapq.nlargest(self.options['top'], (
+            (count / sqrt(size * len(self.item_users[other])), other)
+            for other, count in common.items()
+            if count >= self.options['min_common']
+        ))
+
+    @transaction.atomic
+    def store(self, rows):
+        recipe_ids = [recipe_id for recipe_id, _ in rows]
+        similar = [
+            SimilarRecipe(recipe_id=recipe_id, similar_id=other, score=score)
+            for recipe_id in recipe_ids
+            for score, other in self.neighbours(recipe_id)
+        ]
+        SimilarRecipe.objects.filter(recipe_id__in=recipe_ids).delete()
+        SimilarRecipe.objects.bulk_create(similar, batch_size=1000)
+        SimilarityState.objects.bulk_create(
+            [SimilarityState(recipe_id=recipe_id, interactions=total,
+                             computed_at=self.computed_at)
+             for recipe_id, total in rows],
+            update_conflicts=True,
+            unique_fields=['recipe'],
+            update_fields=['interactions', 'computed_at'],
+        )
+        return len(similar)
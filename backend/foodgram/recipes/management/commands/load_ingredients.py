@@ -0,0 +1,148 @@
+import csv
+import io
+import json
+import os
+from itertools import islice
+from time import monotonic
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes import ingredient_index
+from recipes.models import Ingredient
+
+DEFAULT_PATH = os.path.join(settings.BASE_DIR, 'data', 'ingredients.csv')
+CHUNK_SIZE = 64 * 1024
+STAGING_TABLE = 'ingredient_staging'
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if len(row) >= 2:
+            yield row[0].strip(), row[1].strip()
+
+
+def read_json(file):
+    """Потоково разбирает JSON-массив объектов, не читая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if not started and position < len(buffer):
+                if buffer[position] != '[':
+                    raise CommandError('Ожидается JSON-массив ингредиентов')
+                started = True
+                position += 1
+                continue
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise CommandError('Некорректный JSON')
+                break
+            yield item['name'].strip(), item['measurement_unit'].strip()
+        buffer = buffer[position:]
+        if not chunk:
+            return
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+}
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    """Загрузка ингредиентов из CSV или JSON"""
+    help = ('Потоково загружает ингредиенты из data/ingredients.csv '
+            'или .json, пропуская уже существующие')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=DEFAULT_PATH,
+            help='Путь к файлу .csv или .json',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Сколько строк загружать за раз',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise CommandError('Поддерживаются только файлы .csv и .json')
+        if not os.path.exists(path):
+            raise CommandError(f'Файл {path} не найден')
+        load = (self.load_postgres if connection.vendor == 'postgresql'
+                else self.load_batched)
+        started = monotonic()
+        before = Ingredient.objects.count()
+        read = 0
+        with open(path, encoding='utf-8') as file:
+            for batch in batches(reader(file), options['batch_size']):
+                with transaction.atomic():
+                    load(batch)
+                read += len(batch)
+        elapsed = monotonic() - started
+        created = Ingredient.objects.count() - before
+        if created:
+            ingredient_index.invalidate()
+        self.stdout.write(self.style.SUCCESS(
+            f'Прочитано строк: {read}, добавлено: {created}, '
+            f'время: {elapsed:.2f} с, '
+            f'{read / elapsed if elapsed else read:.0f} строк/с'
+        ))
+
+    def load_batched(self, batch):
+        Ingredient.objects.bulk_create(
+            [Ingredient(name=name, measurement_unit=unit)
+             for name, unit in batch],
+            ignore_conflicts=True,
+        )
+
+    def load_postgres(self, batch):
+        """COPY во временную таблицу и INSERT ... ON CONFLICT."""
+        quote = connection.ops.quote_name
+        table = quote(Ingredient._meta.db_table)
+        staging = quote(STAGING_TABLE)
+        data = io.StringIO()
+        csv.writer(data).writerows(batch)
+        data.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS {staging} '
+                f'(name varchar, measurement_unit varchar) '
+                f'ON COMMIT DELETE ROWS'
+            )
+            cursor.copy_expert(
+                f'COPY {staging} (name, measurement_unit) '
+                f'FROM STDIN WITH (FORMAT csv)',
+                data,
+            )
+            cursor.execute(
+                f'INSERT INTO {table} '
+                f'(name, measurement_unit, created_at, updated_at) '
+                f'SELECT DISTINCT name, measurement_unit, now(), now() '
+                f'FROM {staging} '
+                f'ON CONFLICT ON CONSTRAINT {quote("unique ingredient")} '
+                f'DO NOTHING'
+            )
@@ -0,0 +1,137 @@
+import heapq
+from collections import Counter
+from datetime import timedelta
+from time import monotonic
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from api.cache import bump_generation
+from recipes.models import (Checkpoint, Favorite, PopularityBucket,
+                            PopularityWindow, PopularRecipe, Recipe, Tag)
+
+CHECKPOINT = 'popularity_buckets'
+# Длина скользящих окон в днях, счетчики старше самого длинного
+# окна удаляются.
+WINDOW_DAYS = {
+    PopularityWindow.DAY: 1,
+    PopularityWindow.WEEK: 7,
+}
+
+
+def top(scores, limit):
+    """limit пар (id рецепта, счет), лучшие и более новые первыми."""
+    return heapq.nlargest(
+        limit, scores.items(), key=lambda item: (item[1], item[0])
+    )
+
+
+class Command(BaseCommand):
+    """Материализация рейтингов популярности"""
+    help = ('Добавляет новое избранное в дневные счетчики и пересчитывает '
+            'рейтинги популярных рецептов по тегам за день, неделю и все '
+            'время')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top', type=int, default=100,
+            help='Сколько рецептов хранить в каждом рейтинге',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Сколько записей избранного учитывать за раз',
+        )
+
+    def handle(self, *args, **options):
+        started = monotonic()
+        added = self.update_buckets(options['batch_size'])
+        today = timezone.localdate()
+        PopularityBucket.objects.filter(
+            day__lte=today - timedelta(days=max(WINDOW_DAYS.values()))
+        ).delete()
+        tags = list(Tag.objects.values_list('id', flat=True))
+        for window, days in WINDOW_DAYS.items():
+            scores = dict(PopularityBucket.objects.filter(
+                day__gt=today - timedelta(days=days)
+            ).values('recipe_id').annotate(
+                total=Sum('favorites')
+            ).values_list('recipe_id', 'total').order_by())
+            self.store(window, self.rank(scores, tags, options['top']))
+        self.store(PopularityWindow.ALL, self.rank_all_time(
+            tags, options['top']
+        ))
+        # Закэшированные ответы с сортировкой по популярности устарели во
+        # всех процессах: поколение хранится в базе.
+        bump_generation()
+        self.stdout.write(self.style.SUCCESS(
+            f'Новых записей избранного: {added}, '
+            f'время: {monotonic() - started:.2f} с'
+        ))
+
+    def update_buckets(self, batch_size):
+        """Учитывает избранное, добавленное после прошлого запуска."""
+        # Первый запуск начинает с текущего избранного: его created_at
+        # заполнен временем миграции, и оно попало бы в сегодняшний
+        # счетчик. В рейтинг за все время оно входит через счетчики
+        # рецептов.
+        checkpoint, _ = Checkpoint.objects.get_or_create(
+            name=CHECKPOINT,
+            defaults={'position': Favorite.objects.aggregate(
+                last=Max('id')
+            )['last'] or 0},
+        )
+        added = 0
+        while True:
+            rows = list(Favorite.objects.filter(
+                id__gt=checkpoint.position
+            ).order_by('id').values_list(
+                'id', 'recipe_id', 'created_at'
+            )[:batch_size])
+            if not rows:
+                return added
+            counts = Counter(
+                (recipe_id, timezone.localdate(created_at))
+                for _, recipe_id, created_at in rows
+            )
+            with transaction.atomic():
+                PopularityBucket.objects.add(counts)
+                checkpoint.position = rows[-1][0]
+                checkpoint.save(update_fields=['position'])
+            added += len(rows)
+
+    def rank(self, scores, tags, limit):
+        """Рейтинги {id тега или None: [(id рецепта, счет)]}."""
+        by_tag = {tag_id: {} for tag_id in tags}
+        for tag_id, recipe_id in Recipe.tags.through.objects.filter(
+            recipe_id__in=scores
+        ).values_list('tag_id', 'recipe_id'):
+            by_tag[tag_id][recipe_id] = scores[recipe_id]
+        rankings = {None: top(scores, limit)}
+        for tag_id, tag_scores in by_tag.items():
+            rankings[tag_id] = top(tag_scores, limit)
+        return rankings
+
+    def rank_all_time(self, tags, limit):
+        recipes = Recipe.objects.filter(
+            favorites_count__gt=0
+        ).order_by('-favorites_count', '-id')
+        rankings = {None: list(recipes.values_list(
+            'id', 'favorites_count'
+        )[:limit])}
+        for tag_id in tags:
+            rankings[tag_id] = list(recipes.filter(tags=tag_id).values_list(
+                'id', 'favorites_count'
+            )[:limit])
+        return rankings
+
+    @transaction.atomic
+    def store(self, window, rankings):
+        PopularRecipe.objects.filter(window=window).delete()
+        PopularRecipe.objects.bulk_create([
+            PopularRecipe(window=window, tag_id=tag_id, recipe_id=recipe_id,
+                          score=score)
+            for tag_id, ranking in rankings.items()
+            for recipe_id, score in ranking
+        ], batch_size=1000)
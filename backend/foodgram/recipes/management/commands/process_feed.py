@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from recipes.feed import run_fanout
+from recipes.models import FeedFanout
+
+
+class Command(BaseCommand):
+    """Завершение рассылок рецептов по лентам подписок"""
+    help = ('Дорабатывает рассылки новых рецептов по лентам, прерванные '
+            'до завершения, например при перезапуске сервера')
+
+    def handle(self, *args, **options):
+        done = 0
+        for fanout in FeedFanout.objects.select_related(
+            'recipe'
+        ).order_by('pk').iterator():
+            run_fanout(fanout)
+            done += 1
+        self.stdout.write(self.style.SUCCESS(f'Рассылок завершено: {done}'))
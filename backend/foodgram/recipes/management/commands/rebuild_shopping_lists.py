@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.models import Cart, ShoppingListItem
+
+
+class Command(BaseCommand):
+    """Пересборка и проверка агрегированных списков покупок"""
+    help = ('Сверяет списки покупок с корзинами пользователей '
+            'и пересобирает расходящиеся')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Только проверить, ничего не исправляя',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Сколько пользователей обрабатывать за раз',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user_ids = sorted(
+            set(Cart.objects.values_list('user_id', flat=True))
+            | set(ShoppingListItem.objects.values_list('user_id', flat=True))
+        )
+        drifted = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            broken = self.find_drift(batch)
+            drifted += len(broken)
+            if broken and not options['verify']:
+                with transaction.atomic():
+                    ShoppingListItem.objects.rebuild(broken)
+        self.stdout.write(
+            f'Проверено пользователей: {len(user_ids)}, '
+            f'с расхождениями: {drifted}'
+        )
+        if drifted and options['verify']:
+            raise CommandError('Списки покупок расходятся с корзинами')
+
+    def find_drift(self, user_ids):
+        expected = {
+            (row['user_id'], row['ingredient_id']): row['total']
+            for row in ShoppingListItem.objects.expected(user_ids)
+        }
+        stored = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount
+            in ShoppingListItem.objects.filter(
+                user_id__in=user_ids
+            ).values_list('user_id', 'ingredient_id', 'amount')
+        }
+        return {
+            user_id for user_id, ingredient_id in expected.keys() | stored
+            if expected.get((user_id, ingredient_id))
+            != stored.get((user_id, ingredient_id))
+        }
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Cart, Favorite, Recipe
+from users.models import Follow, User
+
+
+def count_of(model, field):
+    """Подзапрос с числом строк model, ссылающихся на внешний объект."""
+    return Coalesce(Subquery(
+        model.objects.filter(
+            **{field: OuterRef('pk')}
+        ).order_by().values(field).annotate(
+            total=Count('pk')
+        ).values('total')
+    ), 0)
+
+
+COUNTERS = (
+    (Recipe, {
+        'favorites_count': count_of(Favorite, 'recipe'),
+        'carts_count': count_of(Cart, 'recipe'),
+    }),
+    (User, {
+        'recipes_count': count_of(Recipe, 'author'),
+        'followers_count': count_of(Follow, 'following'),
+    }),
+)
+
+
+class Command(BaseCommand):
+    """Сверка денормализованных счетчиков"""
+    help = ('Пересчитывает счетчики избранного, списков покупок, '
+            'рецептов и подписчиков автора и исправляет расхождения')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько объектов проверять за раз',
+        )
+
+    def handle(self, *args, **options):
+        for model, counters in COUNTERS:
+            fixed = self.reconcile(model, counters, options['batch_size'])
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}: исправлено {fixed}'
+            )
+
+    def reconcile(self, model, counters, batch_size):
+        fields = list(counters)
+        actual = {f'actual_{field}': value
+                  for field, value in counters.items()}
+        fixed = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                model.objects.filter(pk__gt=last_pk).order_by('pk').annotate(
+                    **actual
+                ).values('pk', *fields, *actual)[:batch_size]
+            )
+            if not rows:
+                return fixed
+            last_pk = rows[-1]['pk']
+            changed = [
+                row['pk'] for row in rows
+                if any(row[field] != row[f'actual_{field}']
+                       for field in fields)
+            ]
+            if changed:
+                # Пересчет в самом UPDATE не теряет параллельных изменений.
+                model.objects.filter(pk__in=changed).update(**counters)
+                fixed += len(changed)
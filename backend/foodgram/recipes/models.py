@@ -1,8 +1,64 @@
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector, SearchVectorField,
+                                            TrigramSimilarity)
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from users.models import User
+from django.db import connections, models
+from django.db.models import (BooleanField, Case, Exists, F, OuterRef,
+                              Prefetch, Sum, Value, When, Window,
+                              prefetch_related_objects)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest, Lower, RowNumber
+from django.utils import timezone
+from foodgram.utils import DerivedFieldsMixin
+from users.models import Follow, User
 
 MAX_LENGTH = 200
+TRIGRAM_LENGTH = 3
+# Аннотации с данными о текущем пользователе и поля ответа, которым
+# они нужны.
+USER_FLAG_FIELDS = {
+    'is_favorited': 'is_favorited',
+    'is_in_shopping_cart': 'is_in_shopping_cart',
+    'author_is_subscribed': 'author',
+}
+USER_FLAGS = tuple(USER_FLAG_FIELDS)
+# Полнотекстовый поиск рецептов: конфигурация PostgreSQL и таблица
+# FTS5, которая заменяет tsvector в SQLite.
+SEARCH_CONFIG = 'russian'
+RECIPE_FTS_TABLE = 'recipes_recipe_fts'
+
+
+def recipe_search_vector():
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+    )
+
+
+def fts_match(query):
+    """Запрос FTS5: все слова как фразы, без операторов пользователя."""
+    return ' '.join(
+        '"{}"'.format(word.replace('"', '""')) for word in query.split()
+    )
+
+
+def shift_counter(queryset, field, delta):
+    """Атомарно сдвигает счетчик, не опуская его ниже нуля."""
+    return queryset.update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def ingredients_prefetch():
+    return Prefetch(
+        'recipe_ingredient',
+        queryset=RecipeIngredient.objects.select_related('ingredient')
+    )
+
+
+def prefetch_for_read(recipes):
+    """Загружает связи уже полученных рецептов для сериализатора чтения."""
+    prefetch_related_objects(
+        recipes, 'author', 'tags', ingredients_prefetch()
+    )
 
 
 class TagChoice(models.TextChoices):
@@ -12,6 +68,39 @@ class TagChoice(models.TextChoices):
     DINNER = 'Ужин'
 
 
+class IngredientQuerySet(models.QuerySet):
+    """Кверисет ингредиентов"""
+
+    def search(self, query):
+        """Сначала совпадения по префиксу, затем по сходству названия.
+
+        В PostgreSQL поиск по префиксу обслуживает индекс
+        varchar_pattern_ops, по подстроке - триграммный GIN-индекс
+        (см. recipes.signals.create_search_indexes). Триграммы требуют
+        хотя бы трех символов, поэтому короткие запросы ищут по префиксу.
+        """
+        query = query.lower()
+        queryset = self.annotate(name_lower=Lower('name'))
+        if len(query) < TRIGRAM_LENGTH:
+            return queryset.filter(
+                name_lower__startswith=query
+            ).order_by('name')
+        queryset = queryset.filter(
+            name_lower__contains=query
+        ).annotate(
+            is_prefix=Case(
+                When(name_lower__startswith=query, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            )
+        )
+        if connections[self.db].vendor != 'postgresql':
+            return queryset.order_by('-is_prefix', 'name')
+        return queryset.annotate(
+            similarity=TrigramSimilarity('name_lower', query)
+        ).order_by('-is_prefix', '-similarity', 'name')
+
+
 class Ingredient(models.Model):
     """Модель ингредиента"""
     name = models.CharField(
@@ -23,6 +112,17 @@ class Ingredient(models.Model):
         max_length=MAX_LENGTH,
         verbose_name='Единица измерения'
     )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Создан',
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Изменен',
+    )
+
+    objects = IngredientQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.name} / {self.measurement_unit}"
@@ -35,6 +135,10 @@ class Ingredient(models.Model):
             models.UniqueConstraint(fields=['name', 'measurement_unit'],
                                     name='unique ingredient')
         ]
+        indexes = [
+            models.Index(fields=['updated_at', 'id'],
+                         name='ingredient_updated_idx')
+        ]
 
 
 class Tag(models.Model):
@@ -70,6 +174,15 @@ class Tag(models.Model):
         unique=True,
         verbose_name='Слаг'
     )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Создан',
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Изменен',
+    )
 
     def __str__(self):
         return self.name
@@ -78,10 +191,102 @@ class Tag(models.Model):
         ordering = ['name']
         verbose_name = 'Тег'
         verbose_name_plural = 'Теги'
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='tag_updated_idx')
+        ]
 
 
-class Recipe(models.Model):
+class RecipeQuerySet(models.QuerySet):
+    """Кверисет рецептов с оптимизированным чтением"""
+
+    def with_user_flags(self, user, flags=USER_FLAGS):
+        """Аннотирует флаги избранного, корзины и подписки на автора."""
+        if user is None or not user.is_authenticated:
+            false = Value(False, output_field=BooleanField())
+            return self.annotate(**{flag: false for flag in flags})
+        subqueries = {
+            'is_favorited': Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk')
+            ),
+            'is_in_shopping_cart': Cart.objects.filter(
+                user=user, recipe=OuterRef('pk')
+            ),
+            'author_is_subscribed': Follow.objects.filter(
+                user=user, following=OuterRef('author')
+            ),
+        }
+        return self.annotate(**{
+            flag: Exists(subqueries[flag]) for flag in flags
+        })
+
+    def search(self, query):
+        """Рецепты по словам из названия и описания, лучшие первыми.
+
+        В PostgreSQL - по полю search_vector с GIN-индексом, в SQLite -
+        по таблице FTS5 (см. recipes.signals.create_recipe_search).
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            search_query = SearchQuery(
+                query, config=SEARCH_CONFIG, search_type='websearch'
+            )
+            return self.filter(search_vector=search_query).annotate(
+                rank=SearchRank(F('search_vector'), search_query)
+            ).order_by('-rank', '-id')
+        match = fts_match(query)
+        if connection.vendor != 'sqlite' or not match:
+            return self.none()
+        quote = connection.ops.quote_name
+        fts = quote(RECIPE_FTS_TABLE)
+        # bm25 тем меньше, чем лучше совпадение.
+        return self.annotate(rank=RawSQL(
+            f'SELECT bm25({fts}) FROM {fts} WHERE {fts} MATCH %s '
+            f'AND rowid = {quote(self.model._meta.db_table)}.id',
+            (match,),
+        )).filter(rank__isnull=False).order_by('rank', '-id')
+
+    def latest_per_author(self, limit=None):
+        """Не более limit последних рецептов каждого автора."""
+        if limit is None:
+            return self.order_by('-id')
+        return self.annotate(
+            author_row=Window(
+                RowNumber(),
+                partition_by=F('author'),
+                order_by=F('id').desc(),
+            )
+        ).filter(author_row__lte=limit).order_by('-id')
+
+    def for_read(self, user, fields=None, flags=True):
+        """Число запросов не зависит от количества рецептов.
+
+        fields - поля ответа, которые нужно отдать (None - все): связи и
+        подзапросы для остальных полей не загружаются. flags=False -
+        флаги пользователя берет сериализатор (api.viewer_state).
+        """
+        def wanted(field):
+            return fields is None or field in fields
+
+        queryset = self
+        if wanted('author'):
+            queryset = queryset.select_related('author')
+        if wanted('tags'):
+            queryset = queryset.prefetch_related('tags')
+        if wanted('ingredients'):
+            queryset = queryset.prefetch_related(ingredients_prefetch())
+        if not wanted('text'):
+            queryset = queryset.defer('text')
+        if not flags:
+            return queryset
+        return queryset.with_user_flags(user, [
+            flag for flag, field in USER_FLAG_FIELDS.items() if wanted(field)
+        ])
+
+
+class Recipe(DerivedFieldsMixin, models.Model):
     """Модель рецепта"""
+    derived_fields = ('favorites_count', 'carts_count', 'search_vector')
+
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -125,6 +330,32 @@ class Recipe(models.Model):
         ),
         verbose_name='Время приготовления (мин)'
     )
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        db_index=True,
+        editable=False,
+        verbose_name='В избранном',
+    )
+    carts_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='В списках покупок',
+    )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Создан',
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Изменен',
+    )
+
+    objects = RecipeQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -133,6 +364,10 @@ class Recipe(models.Model):
         ordering = ['-id']
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(fields=['updated_at', 'id'],
+                         name='recipe_updated_idx')
+        ]
 
 
 class RecipeIngredient(models.Model):
@@ -174,6 +409,8 @@ class RecipeIngredient(models.Model):
 
 class Favorite(models.Model):
     """Модель избранного"""
+    counter_field = 'favorites_count'
+
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -186,6 +423,11 @@ class Favorite(models.Model):
         related_name='favorites',
         verbose_name='Рецепт',
     )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Добавлен',
+    )
 
     class Meta:
         ordering = ['-user__id']
@@ -195,6 +437,10 @@ class Favorite(models.Model):
             models.UniqueConstraint(fields=['user', 'recipe'],
                                     name='unique_favorite_recipe')
         ]
+        indexes = [
+            models.Index(fields=['recipe', 'user'],
+                         name='favorite_recipe_user_idx')
+        ]
 
     def __str__(self):
         return f'{self.user.username} - {self.recipe.name}'
@@ -202,6 +448,8 @@ class Favorite(models.Model):
 
 class Cart(models.Model):
     """Модель списка покупок"""
+    counter_field = 'carts_count'
+
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -214,6 +462,11 @@ class Cart(models.Model):
         related_name='cart',
         verbose_name='Рецепт',
     )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Добавлен',
+    )
 
     class Meta:
         ordering = ['-id']
@@ -223,6 +476,387 @@ class Cart(models.Model):
             models.UniqueConstraint(fields=['user', 'recipe'],
                                     name='unique_cart_user')
         ]
+        indexes = [
+            models.Index(fields=['recipe', 'user'],
+                         name='cart_recipe_user_idx')
+        ]
 
     def __str__(self):
         return f'{self.user.username} - {self.recipe.name}'
+
+
+class ShoppingListQuerySet(models.QuerySet):
+    """Кверисет агрегированного списка покупок"""
+
+    def apply_deltas(self, user_ids, deltas):
+        """Прибавляет к спискам пользователей {ingredient_id: amount}."""
+        deltas = {key: value for key, value in deltas.items() if value}
+        if not deltas:
+            return
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        self.bulk_create(
+            [
+                self.model(user_id=user_id, ingredient_id=ingredient_id)
+                for user_id in user_ids
+                for ingredient_id, amount in deltas.items() if amount > 0
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        items = self.filter(user_id__in=user_ids, ingredient_id__in=deltas)
+        items.update(amount=Greatest(
+            F('amount') + Case(
+                *(When(ingredient_id=ingredient_id, then=Value(amount))
+                  for ingredient_id, amount in deltas.items()),
+                default=Value(0),
+            ),
+            Value(0),
+        ))
+        items.filter(amount=0).delete()
+
+    @staticmethod
+    def recipe_amounts(recipe_ids, sign=1):
+        """Суммы ингредиентов рецептов {ingredient_id: amount}."""
+        return {
+            ingredient_id: sign * amount
+            for ingredient_id, amount in RecipeIngredient.objects.filter(
+                recipe_id__in=recipe_ids
+            ).values_list('ingredient_id').annotate(
+                total=Sum('amount')
+            ).order_by()
+        }
+
+    def add_recipes(self, user_id, recipe_ids, sign=1):
+        """Учитывает рецепты, добавленные в корзину (или удаленные)."""
+        if not recipe_ids:
+            return
+        self.apply_deltas([user_id], self.recipe_amounts(recipe_ids, sign))
+
+    def remove_recipes(self, user_id, recipe_ids):
+        self.add_recipes(user_id, recipe_ids, sign=-1)
+
+    def add_recipe(self, user_id, recipe_id):
+        self.add_recipes(user_id, [recipe_id])
+
+    def remove_recipe(self, user_id, recipe_id):
+        self.remove_recipes(user_id, [recipe_id])
+
+    def change_recipe(self, recipe_id, deltas):
+        """Применяет изменения ингредиентов рецепта ко всем корзинам."""
+        self.apply_deltas(
+            Cart.objects.filter(recipe_id=recipe_id).values_list(
+                'user_id', flat=True
+            ),
+            deltas,
+        )
+
+    def expected(self, user_ids):
+        """Суммы ингредиентов, посчитанные заново по корзинам."""
+        return Cart.objects.using(self.db).filter(
+            user_id__in=user_ids,
+            recipe__recipe_ingredient__isnull=False,
+        ).values(
+            'user_id',
+            ingredient_id=F('recipe__recipe_ingredient__ingredient'),
+        ).annotate(
+            total=Sum('recipe__recipe_ingredient__amount')
+        ).order_by()
+
+    def rebuild(self, user_ids):
+        """Пересобирает списки покупок пользователей с нуля."""
+        user_ids = list(user_ids)
+        self.filter(user_id__in=user_ids).delete()
+        self.bulk_create(
+            [
+                self.model(user_id=row['user_id'],
+                           ingredient_id=row['ingredient_id'],
+                           amount=row['total'])
+                for row in self.expected(user_ids)
+            ],
+            batch_size=1000,
+        )
+
+
+class ShoppingListItem(models.Model):
+    """Агрегированный список покупок пользователя"""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Ингредиент',
+    )
+    amount = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество',
+    )
+
+    objects = ShoppingListQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['user', 'ingredient']
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ingredient'],
+                                    name='unique_shopping_list_item')
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} - {self.amount} {self.ingredient}'
+
+
+class SimilarRecipe(models.Model):
+    """Похожий рецепт по совместному избранному и спискам покупок"""
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_recipes',
+        verbose_name='Рецепт',
+    )
+    similar = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_to',
+        verbose_name='Похожий рецепт',
+    )
+    score = models.FloatField(verbose_name='Сходство')
+
+    class Meta:
+        ordering = ['recipe', '-score']
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        constraints = [
+            models.UniqueConstraint(fields=['recipe', 'similar'],
+                                    name='unique_similar_recipe')
+        ]
+        indexes = [
+            models.Index(fields=['recipe', '-score'],
+                         name='similar_recipe_score_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.recipe_id} ~ {self.similar_id}: {self.score:.3f}'
+
+
+class SimilarityState(models.Model):
+    """Число взаимодействий с рецептом при последнем расчете похожих"""
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='similarity_state',
+        verbose_name='Рецепт',
+    )
+    interactions = models.PositiveIntegerField(
+        verbose_name='Избранное и списки покупок'
+    )
+    computed_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Рассчитано по данным на',
+    )
+
+    class Meta:
+        verbose_name = 'Состояние похожих рецептов'
+        verbose_name_plural = 'Состояния похожих рецептов'
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте подписок пользователя"""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed',
+        verbose_name='Пользователь',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт',
+    )
+
+    class Meta:
+        ordering = ['user', '-recipe']
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'],
+                                    name='unique_feed_entry')
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} - {self.recipe_id}'
+
+
+class FeedFanout(models.Model):
+    """Незавершенная рассылка рецепта по лентам подписчиков"""
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='fanout',
+        verbose_name='Рецепт',
+    )
+    last_follow_id = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name='Последняя обработанная подписка',
+    )
+
+    class Meta:
+        verbose_name = 'Рассылка по лентам'
+        verbose_name_plural = 'Рассылки по лентам'
+
+
+class PopularityBucketQuerySet(models.QuerySet):
+    """Кверисет дневных счетчиков популярности"""
+
+    def add(self, counts):
+        """Прибавляет {(recipe_id, day): число} к счетчикам."""
+        self.bulk_create(
+            [self.model(recipe_id=recipe_id, day=day)
+             for recipe_id, day in counts],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        days = {}
+        for (recipe_id, day), count in counts.items():
+            days.setdefault(day, {})[recipe_id] = count
+        for day, recipes in days.items():
+            self.filter(day=day, recipe_id__in=recipes).update(
+                favorites=F('favorites') + Case(
+                    *(When(recipe_id=recipe_id, then=Value(count))
+                      for recipe_id, count in recipes.items()),
+                    default=Value(0),
+                )
+            )
+
+
+class PopularityBucket(models.Model):
+    """Число добавлений рецепта в избранное за день"""
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='popularity_buckets',
+        verbose_name='Рецепт',
+    )
+    day = models.DateField(verbose_name='День')
+    favorites = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Добавлений в избранное',
+    )
+
+    objects = PopularityBucketQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-day', 'recipe']
+        verbose_name = 'Популярность за день'
+        verbose_name_plural = 'Популярность по дням'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'recipe'],
+                                    name='unique_popularity_bucket')
+        ]
+
+
+class PopularityWindow(models.TextChoices):
+    """Периоды рейтингов популярности"""
+    DAY = 'day', 'За день'
+    WEEK = 'week', 'За неделю'
+    ALL = 'all', 'За все время'
+
+
+class PopularRecipe(models.Model):
+    """Место рецепта в рейтинге популярности за период"""
+    window = models.CharField(
+        max_length=8,
+        choices=PopularityWindow.choices,
+        verbose_name='Период',
+    )
+    tag = models.ForeignKey(
+        Tag,
+        on_delete=models.CASCADE,
+        null=True,
+        related_name='popular_recipes',
+        verbose_name='Тег',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='popularity',
+        verbose_name='Рецепт',
+    )
+    score = models.PositiveIntegerField(verbose_name='Добавлений')
+
+    class Meta:
+        ordering = ['window', 'tag', '-score']
+        verbose_name = 'Популярный рецепт'
+        verbose_name_plural = 'Популярные рецепты'
+        indexes = [
+            models.Index(fields=['window', 'tag', '-score'],
+                         name='popular_recipe_rank_idx')
+        ]
+
+
+class Checkpoint(models.Model):
+    """Последний обработанный объект периодической задачи"""
+    name = models.CharField(
+        max_length=MAX_LENGTH,
+        primary_key=True,
+        verbose_name='Задача',
+    )
+    position = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name='Последний id',
+    )
+
+    class Meta:
+        verbose_name = 'Позиция задачи'
+        verbose_name_plural = 'Позиции задач'
+
+
+class PantryChange(models.Model):
+    """Рецепт, который нужно перечитать в индексе по ингредиентам"""
+    id = models.BigAutoField(primary_key=True)
+    recipe_id = models.PositiveIntegerField(verbose_name='id рецепта')
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Изменен',
+    )
+
+    class Meta:
+        verbose_name = 'Изменение индекса ингредиентов'
+        verbose_name_plural = 'Изменения индекса ингредиентов'
+
+    def __str__(self):
+        return f'{self.id}: {self.recipe_id}'
+
+
+class Tombstone(models.Model):
+    """Запись об удаленном объекте для синхронизации клиентов"""
+    model = models.CharField(
+        max_length=MAX_LENGTH,
+        verbose_name='Модель',
+    )
+    object_id = models.PositiveBigIntegerField(verbose_name='id объекта')
+    deleted_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Удален',
+    )
+
+    class Meta:
+        ordering = ['deleted_at', 'id']
+        verbose_name = 'Удаленный объект'
+        verbose_name_plural = 'Удаленные объекты'
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'],
+                         name='tombstone_deleted_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.model} {self.object_id}'
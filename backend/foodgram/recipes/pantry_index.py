@@ -0,0 +1,301 @@
+"""Обратный индекс ингредиент -> рецепты для поиска по продуктам.
+
+Снимок индекса - массивы NumPy: id рецептов, отсортированные по
+ингредиенту (postings), смещения списков по id ингредиента (offsets),
+число ингредиентов и время приготовления по id рецепта. На миллион
+рецептов по 8 ингредиентов это около 32 МБ списков и 6 МБ на рецепты.
+Запрос складывает списки своих ингредиентов через np.bincount и
+ранжирует кандидатов без цикла по рецептам.
+
+Изменения пишутся в журнал PantryChange в той же транзакции, что и
+рецепты (mark_changed), поэтому их видят все процессы. Процесс читает
+журнал не чаще раза в PANTRY_INDEX_CHECK_INTERVAL секунд и держит
+перечитанные рецепты поверх снимка. Записи журнала фиксируются не в
+порядке id, поэтому последние CHANGE_OVERLAP записей читаются повторно.
+Снимок перестраивается в фоновом потоке раз в
+PANTRY_INDEX_REBUILD_INTERVAL секунд или когда измененных рецептов
+больше MAX_OVERLAY, запрос ждет только первую сборку.
+"""
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from itertools import chain
+from time import monotonic
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import PantryChange, Recipe, RecipeIngredient
+
+CHANGE_OVERLAP = 100
+MAX_OVERLAY = 10000
+# Записи журнала старше этого срока удаляются при перестройке, снимок
+# старше него перестраивается синхронно.
+CHANGE_RETENTION = timedelta(days=1)
+
+
+def mark_changed(recipe_ids):
+    """Записывает измененные рецепты в журнал текущей транзакции."""
+    recipe_ids = set(recipe_ids)
+    if recipe_ids:
+        PantryChange.objects.bulk_create(
+            [PantryChange(recipe_id=recipe_id) for recipe_id in recipe_ids]
+        )
+        transaction.on_commit(pantry_index.expire)
+
+
+def latest_change():
+    return PantryChange.objects.order_by('-id').values_list(
+        'id', flat=True
+    ).first() or 0
+
+
+def fetch_pairs(queryset):
+    """Пары значений запроса values_list в массиве n x 2."""
+    return np.fromiter(
+        chain.from_iterable(queryset.order_by().iterator(chunk_size=10000)),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+
+class Snapshot:
+    """Неизменяемый снимок индекса"""
+
+    def __init__(self, recipes, pairs):
+        """recipes - пары (id, время), pairs - пары (рецепт, ингредиент)."""
+        size = int(recipes[:, 0].max()) + 1 if len(recipes) else 0
+        present = np.zeros(size, dtype=bool)
+        present[recipes[:, 0]] = True
+        self.cooking_times = np.zeros(size, dtype=np.int32)
+        self.cooking_times[recipes[:, 0]] = recipes[:, 1]
+        # Рецепты, удаленные между запросами, пропускаются, а созданные
+        # между ними придут из журнала.
+        pairs = pairs[pairs[:, 0] < size]
+        pairs = pairs[present[pairs[:, 0]]]
+        pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+        self.postings = pairs[:, 0].astype(np.int32)
+        ingredients = pairs[:, 1]
+        width = int(ingredients.max()) + 1 if len(ingredients) else 0
+        self.offsets = np.zeros(width + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ingredients, minlength=width),
+                  out=self.offsets[1:])
+        self.counts = np.bincount(
+            self.postings, minlength=size
+        ).astype(np.uint16)
+
+    @classmethod
+    def load(cls):
+        return cls(
+            fetch_pairs(Recipe.objects.values_list('id', 'cooking_time')),
+            fetch_pairs(RecipeIngredient.objects.values_list(
+                'recipe_id', 'ingredient_id'
+            )),
+        )
+
+    def hits(self, wanted):
+        """Число совпавших ингредиентов по id рецепта."""
+        wanted = wanted[wanted < len(self.offsets) - 1]
+        lists = [
+            self.postings[start:end] for start, end
+            in zip(self.offsets[wanted], self.offsets[wanted + 1])
+        ]
+        if not lists:
+            return np.zeros(0, dtype=np.int64)
+        return np.bincount(np.concatenate(lists),
+                           minlength=len(self.counts))
+
+
+class State:
+    """Снимок и перечитанные после него рецепты"""
+
+    def __init__(self, snapshot, overlay=None):
+        self.snapshot = snapshot
+        # id рецепта -> (ингредиенты, время) или None для удаленных.
+        self.overlay = overlay or {}
+        self.overlay_ids = np.fromiter(
+            self.overlay, dtype=np.int64, count=len(self.overlay)
+        )
+
+    def changed(self, entries):
+        return State(self.snapshot, {**self.overlay, **entries})
+
+    def rank(self, ingredient_ids, max_cooking_time=None):
+        """Кандидаты запроса для PantryRanking."""
+        wanted = np.unique(np.fromiter(ingredient_ids, dtype=np.int64))
+        wanted = wanted[wanted >= 0]
+        snapshot = self.snapshot
+        hits = snapshot.hits(wanted)
+        recipe_ids = np.flatnonzero(hits)
+        if len(self.overlay_ids):
+            recipe_ids = recipe_ids[
+                ~np.isin(recipe_ids, self.overlay_ids, assume_unique=True)
+            ]
+        found = hits[recipe_ids]
+        counts = snapshot.counts[recipe_ids]
+        cooking_times = snapshot.cooking_times[recipe_ids]
+        extra = []
+        wanted_set = set(wanted.tolist())
+        for recipe_id, entry in self.overlay.items():
+            if entry is not None:
+                ingredients, cooking_time = entry
+                matched = len(ingredients & wanted_set)
+                if matched:
+                    extra.append((recipe_id, matched, len(ingredients),
+                                  cooking_time))
+        if extra:
+            extra = np.array(extra, dtype=np.int64)
+            recipe_ids = np.concatenate([recipe_ids, extra[:, 0]])
+            found = np.concatenate([found, extra[:, 1]])
+            counts = np.concatenate([counts, extra[:, 2]])
+            cooking_times = np.concatenate([cooking_times, extra[:, 3]])
+        if max_cooking_time is not None:
+            fits = cooking_times <= max_cooking_time
+            recipe_ids, found, counts = (
+                recipe_ids[fits], found[fits], counts[fits]
+            )
+        return PantryRanking(recipe_ids, found, counts)
+
+
+class PantryRanking:
+    """Кандидаты одного запроса, отсортированные по требованию.
+
+    Покрытие - доля ингредиентов рецепта, которые есть у пользователя.
+    При равном покрытии выше рецепты, где совпало больше ингредиентов,
+    затем более новые.
+    """
+
+    def __init__(self, recipe_ids, found, counts):
+        self.recipe_ids = recipe_ids
+        self.found = found
+        self.coverage = found / counts
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    def top(self, limit):
+        """limit пар (покрытие, id рецепта), лучшие первыми."""
+        limit = max(limit, 0)
+        selected = np.arange(len(self))
+        if limit < len(self):
+            # Полная сортировка нужна только рецептам не хуже k-го.
+            kth = len(self) - limit
+            threshold = np.partition(self.coverage, kth)[kth]
+            selected = np.flatnonzero(self.coverage >= threshold)
+        order = selected[np.lexsort((
+            self.recipe_ids[selected],
+            self.found[selected],
+            self.coverage[selected],
+        ))[::-1][:limit]]
+        return list(zip(self.coverage[order].tolist(),
+                        self.recipe_ids[order].tolist()))
+
+
+def load_entries(recipe_ids):
+    """Актуальные ингредиенты и время приготовления рецептов."""
+    cooking_times = dict(Recipe.objects.filter(
+        id__in=recipe_ids
+    ).values_list('id', 'cooking_time'))
+    ingredients = defaultdict(set)
+    for recipe_id, ingredient_id in RecipeIngredient.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'ingredient_id'):
+        ingredients[recipe_id].add(ingredient_id)
+    return {
+        recipe_id: (frozenset(ingredients[recipe_id]),
+                    cooking_times[recipe_id])
+        if recipe_id in cooking_times and ingredients[recipe_id] else None
+        for recipe_id in recipe_ids
+    }
+
+
+class PantryIndex:
+    """Индекс в памяти процесса с журналом изменений в базе"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.position = 0
+        self.seen = frozenset()
+        self.checked = 0
+        self.built = 0
+        self.rebuilding = False
+
+    def expire(self):
+        self.checked = 0
+
+    def install(self, snapshot, position):
+        """Ставит новый снимок и догоняет журнал с его позиции."""
+        self.state = State(snapshot)
+        self.position = position
+        self.seen = frozenset()
+        self.built = monotonic()
+        self.refresh()
+
+    def refresh(self):
+        self.checked = monotonic() + settings.PANTRY_INDEX_CHECK_INTERVAL
+        changes = list(PantryChange.objects.filter(
+            id__gt=self.position - CHANGE_OVERLAP
+        ).order_by('id').values_list('id', 'recipe_id'))
+        recipe_ids = {
+            recipe_id for change_id, recipe_id in changes
+            if change_id not in self.seen
+        }
+        if recipe_ids:
+            self.state = self.state.changed(load_entries(recipe_ids))
+        if changes:
+            self.position = max(self.position, changes[-1][0])
+        self.seen = frozenset(
+            change_id for change_id, _ in changes
+            if change_id > self.position - CHANGE_OVERLAP
+        )
+        if not self.rebuilding and (
+            len(self.state.overlay) > MAX_OVERLAY
+            or monotonic() - self.built
+            > settings.PANTRY_INDEX_REBUILD_INTERVAL
+        ):
+            self.rebuilding = True
+            threading.Thread(target=self.rebuild_in_thread,
+                             daemon=True).start()
+
+    def build(self):
+        position = latest_change()
+        return Snapshot.load(), position
+
+    def rebuild_in_thread(self):
+        try:
+            PantryChange.objects.filter(
+                created_at__lt=timezone.now() - CHANGE_RETENTION
+            ).delete()
+            snapshot, position = self.build()
+            with self.lock:
+                self.install(snapshot, position)
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def outdated(self):
+        return self.state is None or (
+            monotonic() - self.built > CHANGE_RETENTION.total_seconds()
+        )
+
+    def load(self):
+        if self.outdated():
+            with self.lock:
+                if self.outdated():
+                    self.install(*self.build())
+        elif monotonic() >= self.checked and self.lock.acquire(False):
+            # Пока другой запрос читает журнал, используется прежний
+            # снимок.
+            try:
+                self.refresh()
+            finally:
+                self.lock.release()
+        return self.state
+
+    def rank(self, ingredient_ids, max_cooking_time=None):
+        return self.load().rank(ingredient_ids, max_cooking_time)
+
+
+pantry_index = PantryIndex()
@@ -0,0 +1,307 @@
+from collections import Counter
+
+from django.db import connections, transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.models import User
+
+from . import ingredient_index, pantry_index
+from .feed import schedule_fanout
+from .models import (RECIPE_FTS_TABLE, Cart, Favorite, Ingredient, Recipe,
+                     RecipeIngredient, ShoppingListItem, Tag, Tombstone,
+                     recipe_search_vector, shift_counter)
+
+SHOPPING_LIST_BATCH = 500
+
+SEARCH_FIELDS = {'name', 'text'}
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def invalidate_ingredient_index(sender, **kwargs):
+    ingredient_index.invalidate()
+
+
+@receiver([post_save, post_delete], sender=RecipeIngredient)
+def update_pantry_index(sender, instance, origin=None, **kwargs):
+    # Удаление рецепта отмечает update_pantry_recipe.
+    if isinstance(origin, Recipe):
+        return
+    pantry_index.mark_changed([instance.recipe_id])
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def update_pantry_recipe(sender, instance, update_fields=None, **kwargs):
+    if not update_fields or 'cooking_time' in update_fields:
+        pantry_index.mark_changed([instance.pk])
+
+
+def touch_recipes(queryset):
+    """Отмечает изменение рецептов для синхронизации клиентов."""
+    queryset.update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=RecipeIngredient)
+def touch_recipe_ingredients(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Recipe):
+        return
+    touch_recipes(Recipe.objects.filter(pk=instance.recipe_id))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipe_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            touch_recipes(Recipe.objects.filter(pk=instance.pk))
+    elif action == 'pre_clear':
+        # После очистки рецепты тега уже не найти.
+        touch_recipes(Recipe.objects.filter(tags=instance))
+    elif action in ('post_add', 'post_remove'):
+        touch_recipes(Recipe.objects.filter(pk__in=pk_set))
+
+
+@receiver(pre_delete, sender=Tag)
+def touch_tag_recipes(sender, instance, **kwargs):
+    # Связи с тегом удаляются каскадом без m2m_changed.
+    touch_recipes(Recipe.objects.filter(tags=instance))
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Tag)
+def create_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(
+        model=sender._meta.model_name, object_id=instance.pk
+    )
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=Cart)
+def increment_recipe_counter(sender, instance, created, **kwargs):
+    if created:
+        shift_counter(Recipe.objects.filter(pk=instance.recipe_id),
+                      sender.counter_field, 1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=Cart)
+def decrement_recipe_counter(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Recipe):
+        return
+    shift_counter(Recipe.objects.filter(pk=instance.recipe_id),
+                  sender.counter_field, -1)
+
+
+@receiver(pre_save, sender=Cart)
+@receiver(pre_save, sender=RecipeIngredient)
+def remember_stored(sender, instance, **kwargs):
+    """Запоминает сохраненную строку, чтобы учесть ее изменение."""
+    instance._stored = None if instance._state.adding else (
+        sender.objects.filter(pk=instance.pk).first()
+    )
+
+
+@receiver(post_save, sender=Cart)
+def update_shopping_list(sender, instance, **kwargs):
+    stored = getattr(instance, '_stored', None)
+    if stored is not None:
+        if (stored.user_id, stored.recipe_id) == (instance.user_id,
+                                                  instance.recipe_id):
+            return
+        ShoppingListItem.objects.remove_recipe(stored.user_id,
+                                               stored.recipe_id)
+    ShoppingListItem.objects.add_recipe(instance.user_id, instance.recipe_id)
+
+
+@receiver(post_delete, sender=Cart)
+def shrink_shopping_list(sender, instance, origin=None, **kwargs):
+    # При удалении рецепта его вычитает subtract_deleted_recipe,
+    # при удалении пользователя его список удаляется каскадом.
+    if isinstance(origin, (Recipe, User)):
+        return
+    ShoppingListItem.objects.remove_recipe(instance.user_id,
+                                           instance.recipe_id)
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def update_shopping_lists(sender, instance, **kwargs):
+    deltas = Counter({instance.ingredient_id: instance.amount})
+    stored = getattr(instance, '_stored', None)
+    if stored is not None:
+        if stored.recipe_id == instance.recipe_id:
+            deltas[stored.ingredient_id] -= stored.amount
+        else:
+            ShoppingListItem.objects.change_recipe(
+                stored.recipe_id, {stored.ingredient_id: -stored.amount}
+            )
+    ShoppingListItem.objects.change_recipe(instance.recipe_id, deltas)
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def shrink_shopping_lists(sender, instance, origin=None, **kwargs):
+    # Позиции удаленного ингредиента удаляются каскадом.
+    if isinstance(origin, (Recipe, User, Ingredient)):
+        return
+    ShoppingListItem.objects.change_recipe(
+        instance.recipe_id, {instance.ingredient_id: -instance.amount}
+    )
+
+
+@receiver(pre_delete, sender=Recipe)
+def subtract_deleted_recipe(sender, instance, **kwargs):
+    """Вычитает рецепт из всех корзин, пока связи еще не удалены."""
+    ShoppingListItem.objects.change_recipe(
+        instance.pk,
+        ShoppingListItem.objects.recipe_amounts([instance.pk], sign=-1),
+    )
+
+
+@receiver(post_save, sender=Recipe)
+def increment_recipes_count(sender, instance, created, **kwargs):
+    if created:
+        shift_counter(User.objects.filter(pk=instance.author_id),
+                      'recipes_count', 1)
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(sender, instance, created, **kwargs):
+    if created:
+        schedule_fanout(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def decrement_recipes_count(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, User):
+        return
+    shift_counter(User.objects.filter(pk=instance.author_id),
+                  'recipes_count', -1)
+
+
+def create_search_indexes(sender, using, **kwargs):
+    """Индексы для поиска ингредиентов по префиксу и подстроке."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    table = connection.ops.quote_name(Ingredient._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_pattern '
+            f'ON {table} (lower(name) varchar_pattern_ops)'
+        )
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_trgm '
+            f'ON {table} USING gin (lower(name) gin_trgm_ops)'
+        )
+
+
+def create_relation_indexes(sender, using, **kwargs):
+    """Индекс (tag_id, recipe_id) автоматической таблицы тегов рецепта.
+
+    Уникальный индекс (recipe_id, tag_id) Django создает сам, составной
+    в обратном порядке позволяет выбирать рецепты тега только по индексу.
+    """
+    connection = connections[using]
+    table = connection.ops.quote_name(Recipe.tags.through._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS recipes_recipe_tags_tag_recipe '
+            f'ON {table} (tag_id, recipe_id)'
+        )
+
+
+def update_search_index(recipe_ids, using):
+    """Обновляет поисковые данные рецептов."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        Recipe.objects.using(using).filter(pk__in=recipe_ids).update(
+            search_vector=recipe_search_vector()
+        )
+    elif connection.vendor == 'sqlite':
+        remove_from_search_index(recipe_ids, using)
+        quote = connection.ops.quote_name
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(RECIPE_FTS_TABLE)} (rowid, name, text) '
+                f'SELECT id, name, text '
+                f'FROM {quote(Recipe._meta.db_table)} '
+                f'WHERE id IN ({placeholders})',
+                list(recipe_ids),
+            )
+
+
+def remove_from_search_index(recipe_ids, using):
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    placeholders = ', '.join(['%s'] * len(recipe_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(RECIPE_FTS_TABLE)} '
+            f'WHERE rowid IN ({placeholders})',
+            list(recipe_ids),
+        )
+
+
+@receiver(post_save, sender=Recipe)
+def index_recipe(sender, instance, created, using, update_fields=None,
+                 **kwargs):
+    if created or not update_fields or SEARCH_FIELDS & set(update_fields):
+        update_search_index([instance.pk], using)
+
+
+@receiver(post_delete, sender=Recipe)
+def unindex_recipe(sender, instance, using, **kwargs):
+    remove_from_search_index([instance.pk], using)
+
+
+def create_recipe_search(sender, using, **kwargs):
+    """GIN-индекс по search_vector или таблица FTS5 в SQLite.
+
+    Заполняет поисковые данные рецептов, у которых их еще нет.
+    """
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    table = quote(Recipe._meta.db_table)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS recipes_recipe_search '
+                f'ON {table} USING gin (search_vector)'
+            )
+        Recipe.objects.using(using).filter(
+            search_vector__isnull=True
+        ).update(search_vector=recipe_search_vector())
+    elif connection.vendor == 'sqlite':
+        fts = quote(RECIPE_FTS_TABLE)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {fts} '
+                f'USING fts5(name, text)'
+            )
+            cursor.execute(
+                f'INSERT INTO {fts} (rowid, name, text) '
+                f'SELECT id, name, text FROM {table} '
+                f'WHERE id NOT IN (SELECT rowid FROM {fts})'
+            )
+
+
+def fill_shopping_lists(sender, using, **kwargs):
+    """Собирает списки покупок, если таблица еще пуста.
+
+    Нужно один раз после появления ShoppingListItem, дальше списки
+    поддерживаются сигналами и rebuild_shopping_lists.
+    """
+    items = ShoppingListItem.objects.using(using)
+    if items.exists():
+        return
+    user_ids = sorted(set(Cart.objects.using(using).values_list(
+        'user_id', flat=True
+    )))
+    for start in range(0, len(user_ids), SHOPPING_LIST_BATCH):
+        with transaction.atomic(using=using):
+            items.rebuild(user_ids[start:start + SHOPPING_LIST_BATCH])
@@ -0,0 +1,176 @@
+import random
+from unittest import skipUnless
+
+import numpy as np
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from users.models import User
+
+from .models import Ingredient, Recipe, RecipeIngredient
+from .pantry_index import PantryIndex, Snapshot, State
+
+
+def brute_force(recipes, wanted, limit, max_cooking_time=None):
+    """Ранжирование перебором: {id: (ингредиенты, время)}."""
+    ranked = []
+    for recipe_id, (ingredients, cooking_time) in recipes.items():
+        found = len(ingredients & wanted)
+        if not found or (max_cooking_time is not None
+                         and cooking_time > max_cooking_time):
+            continue
+        ranked.append((found / len(ingredients), found, recipe_id))
+    ranked.sort(reverse=True)
+    return [(coverage, recipe_id) for coverage, _, recipe_id
+            in ranked[:limit]]
+
+
+class PantrySnapshotTest(TestCase):
+    """Ранжирование по массивам совпадает с перебором"""
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.recipes = {
+            recipe_id: (
+                frozenset(rng.sample(range(1, 40), rng.randint(1, 8))),
+                rng.randint(1, 60),
+            )
+            for recipe_id in rng.sample(range(1, 500), 300)
+        }
+        self.queries = [
+            set(rng.sample(range(1, 45), rng.randint(1, 12)))
+            for _ in range(30)
+        ]
+
+    def snapshot(self, recipes):
+        return Snapshot(
+            np.array([(recipe_id, cooking_time) for recipe_id,
+                      (_, cooking_time) in recipes.items()],
+                     dtype=np.int64).reshape(-1, 2),
+            np.array([(recipe_id, ingredient_id) for recipe_id,
+                      (ingredients, _) in recipes.items()
+                      for ingredient_id in ingredients],
+                     dtype=np.int64).reshape(-1, 2),
+        )
+
+    def test_rank(self):
+        state = State(self.snapshot(self.recipes))
+        for wanted in self.queries:
+            for limit, max_cooking_time in ((5, None), (40, 30), (1000, None)):
+                with self.subTest(wanted=wanted, limit=limit):
+                    self.assertEqual(
+                        state.rank(wanted, max_cooking_time).top(limit),
+                        brute_force(self.recipes, wanted, limit,
+                                    max_cooking_time),
+                    )
+
+    def test_overlay(self):
+        changed = dict(self.recipes)
+        removed, edited = list(self.recipes)[:2]
+        del changed[removed]
+        changed[edited] = (frozenset({1, 2, 3}), 5)
+        changed[1000] = (frozenset({4}), 10)
+        state = State(self.snapshot(self.recipes)).changed({
+            removed: None,
+            edited: changed[edited],
+            1000: changed[1000],
+        })
+        for wanted in self.queries:
+            with self.subTest(wanted=wanted):
+                self.assertEqual(state.rank(wanted).top(20),
+                                 brute_force(changed, wanted, 20))
+
+    def test_empty(self):
+        state = State(self.snapshot({}))
+        self.assertEqual(state.rank([1, 2]).top(10), [])
+
+
+@override_settings(PANTRY_INDEX_CHECK_INTERVAL=0)
+class PantryIndexTest(TestCase):
+    """Индекс догоняет изменения рецептов по журналу в базе"""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            email='author@example.com',
+            username='author',
+            first_name='Имя',
+            last_name='Фамилия',
+            password='password-12345',
+        )
+        cls.ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+            for number in range(4)
+        ])
+        cls.recipes = [
+            Recipe.objects.create(
+                author=author,
+                name=f'Рецепт {number}',
+                text='Описание',
+                cooking_time=10 * (number + 1),
+                image='recipes/images/test.png',
+            )
+            for number in range(3)
+        ]
+        for recipe, ingredients in zip(cls.recipes, (
+            cls.ingredients[:1], cls.ingredients[:2], cls.ingredients[1:4]
+        )):
+            RecipeIngredient.objects.bulk_create([
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=1)
+                for ingredient in ingredients
+            ])
+
+    def setUp(self):
+        self.index = PantryIndex()
+
+    def top(self, ingredients, max_cooking_time=None):
+        return [
+            recipe_id for _, recipe_id in self.index.rank(
+                [ingredient.id for ingredient in ingredients],
+                max_cooking_time,
+            ).top(10)
+        ]
+
+    def test_rank(self):
+        first, second, third = self.recipes
+        self.assertEqual(self.top(self.ingredients[:2]),
+                         [second.id, first.id, third.id])
+        self.assertEqual(self.top(self.ingredients[:2], 20),
+                         [second.id, first.id])
+
+    def test_changes_from_journal(self):
+        first, second, third = self.recipes
+        self.top(self.ingredients[:1])
+        RecipeIngredient.objects.create(
+            recipe=third, ingredient=self.ingredients[0], amount=1
+        )
+        second.delete()
+        self.assertEqual(self.top(self.ingredients[:1]),
+                         [first.id, third.id])
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'Индексы поиска создаются только в PostgreSQL')
+class IngredientSearchPlanTest(TestCase):
+    """Поиск ингредиентов идет по индексам выражения lower(name)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create([
+            Ingredient(name=f'{name} {number}', measurement_unit='г')
+            for name in ('Мука', 'Сахар', 'Молоко')
+            for number in range(100)
+        ])
+
+    def plan(self, query):
+        # На маленькой таблице планировщик иначе выберет полный просмотр.
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return Ingredient.objects.search(query).explain()
+
+    def test_prefix(self):
+        self.assertIn('recipes_ingredient_name_pattern', self.plan('мо'))
+
+    def test_contains(self):
+        self.assertIn('recipes_ingredient_name_trgm', self.plan('ука'))
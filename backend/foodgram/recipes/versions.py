@@ -0,0 +1,20 @@
+from django.db.models import F
+
+from .models import Checkpoint
+
+# Версии данных, общие для всех процессов. Кэш по умолчанию
+# (LocMemCache) у каждого процесса свой, поэтому счетчики, по которым
+# процессы узнают об изменениях, хранятся в таблице Checkpoint.
+
+
+def get_version(name):
+    return Checkpoint.objects.filter(name=name).values_list(
+        'position', flat=True
+    ).first() or 0
+
+
+def bump_version(name):
+    if not Checkpoint.objects.filter(name=name).update(
+        position=F('position') + 1
+    ):
+        Checkpoint.objects.get_or_create(name=name, defaults={'position': 1})
@@ -1,7 +1,8 @@
+from api.viewer_state import viewer_state
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
-from users.models import Follow, User
+from users.models import User
 
 
 class FoodgramUserCreateSerializer(UserCreateSerializer):
@@ -41,7 +42,6 @@ class FoodgramUserSerializer(UserSerializer):
             'last_name', 'is_subscribed')
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return Follow.objects.filter(user=user, following=obj.id).exists()
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        return viewer_state(self.context['request']).is_subscribed(obj.id)
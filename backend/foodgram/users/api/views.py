@@ -1,7 +1,14 @@
 from api.pagination import LimitPageNumberPagination
 from api.serializers import FollowSerializer
+from api.viewer_state import forget_ids
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Prefetch
 from djoser.views import UserViewSet
+from foodgram.toggles import add_relation, parse_id, remove_relation
+from foodgram.utils import get_recipes_limit
+from recipes.feed import backfill, cleanup, unfollowed
+from recipes.models import Recipe, shift_counter
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.generics import get_object_or_404
@@ -18,37 +25,48 @@ class FoodgramUserViewSet(UserViewSet):
 
     @action(detail=True, methods=['post'],
             permission_classes=[IsAuthenticated])
+    @transaction.atomic
     def subscribe(self, request, id=None):
         user = request.user
-        author = get_object_or_404(User, id=id)
+        author_id = parse_id(id)
 
-        if user == author:
+        if user.id == author_id:
             return Response({
                 'errors': 'Невозможно подписаться на самого себя'
             }, status=status.HTTP_400_BAD_REQUEST)
-        if Follow.objects.filter(user=user, following=author).exists():
+        follow_id = add_relation(Follow, user.id, 'following', author_id)
+        if follow_id is None:
+            get_object_or_404(User, id=author_id)
             return Response({
                 'errors': 'Вы уже подписались на этого автора'
             }, status=status.HTTP_400_BAD_REQUEST)
+        forget_ids([user.id])
+        shift_counter(User.objects.filter(id=author_id), 'followers_count', 1)
+        backfill(user.id, author_id)
 
-        follow = Follow.objects.create(user=user, following=author)
+        follow = Follow.objects.select_related('following').get(id=follow_id)
         serializer = FollowSerializer(
             follow, context={'request': request}
         )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @subscribe.mapping.delete
+    @transaction.atomic
     def del_subscribe(self, request, id=None):
         user = request.user
-        author = get_object_or_404(User, id=id)
-        if user == author:
+        author_id = parse_id(id)
+        if user.id == author_id:
             return Response({
                 'errors': 'Невозможно отписаться от самого себя'
             }, status=status.HTTP_400_BAD_REQUEST)
-        follow = Follow.objects.filter(user=user, following=author)
-        if follow.exists():
-            follow.delete()
+        if remove_relation(Follow, user.id, 'following', author_id):
+            forget_ids([user.id])
+            shift_counter(User.objects.filter(id=author_id),
+                          'followers_count', -1)
+            cleanup(user.id, author_id)
+            unfollowed(author_id)
             return Response(status=status.HTTP_204_NO_CONTENT)
+        get_object_or_404(User, id=author_id)
 
         return Response({
             'errors': 'Вы уже отписались'
@@ -56,8 +74,17 @@ class FoodgramUserViewSet(UserViewSet):
 
     @action(detail=False, permission_classes=[IsAuthenticated])
     def subscriptions(self, request):
-        user = request.user
-        queryset = Follow.objects.filter(user=user)
+        queryset = Follow.objects.filter(
+            user=request.user
+        ).select_related(
+            'following'
+        ).prefetch_related(Prefetch(
+            'following__recipes',
+            queryset=Recipe.objects.latest_per_author(
+                get_recipes_limit(request)
+            ),
+            to_attr='limited_recipes',
+        )).order_by('id')
         pages = self.paginate_queryset(queryset)
         serializer = FollowSerializer(
             pages,
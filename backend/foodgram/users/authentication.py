@@ -0,0 +1,113 @@
+import hashlib
+from collections import OrderedDict
+from copy import copy
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+# Поля, которые меняются в обход save() (счетчики через update(), время
+# входа с update_fields) и поэтому в кэше устаревают.
+VOLATILE_FIELDS = ('recipes_count', 'followers_count',
+                   'viewer_state_version', 'last_login')
+
+
+class TokenCache:
+    """Пользователи по токенам: LRU в процессе и общий кэш.
+
+    Записи LRU живут TOKEN_CACHE_LOCAL_TTL секунд: это предел, на
+    который другие процессы могут отстать от сброса записи (forget).
+    Общий кэш (TOKEN_CACHE_ALIAS) используется, только если он виден
+    всем процессам: запись в LocMemCache жила бы TOKEN_CACHE_TTL
+    секунд и пережила бы сброс в другом процессе.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def shared():
+        alias = settings.TOKEN_CACHE_ALIAS
+        if not alias:
+            return None
+        shared = caches[alias]
+        if isinstance(shared, (LocMemCache, DummyCache)):
+            return None
+        return shared
+
+    @staticmethod
+    def cache_key(key):
+        return 'auth_token:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        now = monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                user, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    return user
+                del self.entries[key]
+        shared = self.shared()
+        user = shared.get(self.cache_key(key)) if shared else None
+        if user is not None:
+            self.remember(key, user)
+        return user
+
+    def set(self, key, user):
+        # Без изменчивых полей они считаются отложенными: чтение загрузит
+        # их из базы, а save() запишет только загруженные поля и не вернет
+        # старые значения счетчиков.
+        user = copy(user)
+        for field in VOLATILE_FIELDS:
+            user.__dict__.pop(field, None)
+        shared = self.shared()
+        if shared:
+            shared.set(self.cache_key(key), user, settings.TOKEN_CACHE_TTL)
+        self.remember(key, user)
+
+    def remember(self, key, user):
+        with self.lock:
+            self.entries[key] = (
+                user, monotonic() + settings.TOKEN_CACHE_LOCAL_TTL
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.TOKEN_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def forget(self, keys):
+        keys = list(keys)
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        shared = self.shared()
+        if shared and keys:
+            shared.delete_many([self.cache_key(key) for key in keys])
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Аутентификация по токену без запроса к базе на каждый вызов"""
+
+    def authenticate_credentials(self, key):
+        user = token_cache.get(key)
+        if user is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user)
+            return user, token
+        if not user.is_active:
+            raise AuthenticationFailed('Пользователь неактивен или удален.')
+        # Запись кэша общая для запросов, запрос получает свою копию.
+        user = copy(user)
+        token = self.get_model()(key=key, user_id=user.pk)
+        token.user = user
+        return user, token
@@ -2,9 +2,14 @@ from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.db import models
 
+from foodgram.utils import DerivedFieldsMixin
 
-class User(AbstractUser):
+
+class User(DerivedFieldsMixin, AbstractUser):
     """Модель кастомного пользователя"""
+    derived_fields = ('recipes_count', 'followers_count',
+                      'viewer_state_version')
+
     username = models.CharField(
         max_length=150,
         validators=[AbstractUser.username_validator],
@@ -15,6 +20,21 @@ class User(AbstractUser):
         blank=True
     )
     email = models.EmailField(('Email address'), unique=True)
+    recipes_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество рецептов',
+    )
+    followers_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество подписчиков',
+    )
+    viewer_state_version = models.PositiveBigIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Версия избранного, корзины и подписок',
+    )
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.feed import unfollowed
+from recipes.models import shift_counter
+from users.authentication import token_cache
+from users.models import Follow, User
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # Повторно после коммита: запрос, выполнявшийся во время удаления,
+    # мог снова положить токен в кэш.
+    keys = [instance.key]
+    token_cache.forget(keys)
+    transaction.on_commit(lambda: token_cache.forget(keys))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # Смена пароля, деактивация и другие изменения профиля.
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    keys = list(Token.objects.filter(
+        user_id=instance.pk
+    ).values_list('key', flat=True))
+    token_cache.forget(keys)
+    transaction.on_commit(lambda: token_cache.forget(keys))
+
+
+@receiver(post_save, sender=Follow)
+def increment_followers_count(sender, instance, created, **kwargs):
+    if created:
+        shift_counter(User.objects.filter(pk=instance.following_id),
+                      'followers_count', 1)
+
+
+@receiver(post_delete, sender=Follow)
+def decrement_followers_count(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, User) and origin.pk == instance.following_id:
+        return
+    shift_counter(User.objects.filter(pk=instance.following_id),
+                  'followers_count', -1)
+    unfollowed(instance.following_id)
@@ -0,0 +1,77 @@
+from statistics import median
+from time import perf_counter
+
+from django.core.cache import cache
+from django.test import override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from users.authentication import token_cache
+from users.models import User
+
+WARM_REQUESTS = 50
+LOCAL_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    """Аутентификация по токену из кэша процесса"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='user@example.com',
+            username='user',
+            first_name='Имя',
+            last_name='Фамилия',
+            password='password-12345',
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        token_cache.forget([self.token.key])
+
+    def tearDown(self):
+        token_cache.forget([self.token.key])
+
+    def test_cached_token_skips_database(self):
+        self.client.get('/api/tags/')
+        # Остается только запрос тегов.
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/tags/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout_revokes_cached_token(self):
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 200)
+        self.client.post('/api/auth/token/logout/')
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 401)
+
+    def test_deactivation_revokes_cached_token(self):
+        self.client.get('/api/users/me/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 401)
+
+    @override_settings(CACHES=LOCAL_CACHES, TOKEN_CACHE_ALIAS='default')
+    def test_process_local_cache_is_not_shared(self):
+        self.assertIsNone(token_cache.shared())
+
+    def test_warm_request_latency(self):
+        """Теплый GET /api/tags/ с кэшем токена не медленнее, чем без него"""
+        def timings(cached):
+            self.client.get('/api/tags/')
+            result = []
+            for _ in range(WARM_REQUESTS):
+                if not cached:
+                    token_cache.forget([self.token.key])
+                start = perf_counter()
+                self.client.get('/api/tags/')
+                result.append(perf_counter() - start)
+            return median(result)
+
+        uncached, cached = timings(cached=False), timings(cached=True)
+        print(f'\nGET /api/tags/: {uncached * 1000:.2f} мс без кэша '
+              f'токена, {cached * 1000:.2f} мс с кэшем')
+        self.assertLess(cached, uncached * 1.5)